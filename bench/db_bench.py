@@ -0,0 +1,78 @@
+"""
+commit_exists 查询延迟基准
+
+对比旧实现（每次新建连接 + 无索引全表扫描）和新的存储层（长连接 + WAL + 唯一索引 + 专用线程）
+用法：python -m bench.db_bench [行数] [查询次数]
+"""
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from src import db
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(name, latencies):
+    ms = [x * 1000 for x in latencies]
+    print(f'{name:<28} p50={statistics.median(ms):.3f}ms p99={percentile(ms, 0.99):.3f}ms max={max(ms):.3f}ms')
+
+
+def fill(path, rows):
+    with sqlite3.connect(path) as conn:
+        conn.execute('''create table commit_history (id integer primary key autoincrement, bvid text,
+                        json_data TEXT, up_id integer, up_name text, commit_time text)''')
+        conn.executemany('insert into commit_history (bvid, json_data, up_id, up_name, commit_time) values (?, ?, ?, ?, ?)',
+                         ((f'BV{i:010d}', '{"haveAd": false}', i % 500, f'up{i % 500}', '2025-01-01 00:00:00')
+                          for i in range(rows)))
+
+
+def old_commit_exists(path, bvid):
+    with sqlite3.connect(path) as conn:
+        c = conn.execute('select * from commit_history where bvid = ?', (bvid,))
+        return c.fetchone() is not None
+
+
+async def main(rows: int, queries: int):
+    # 数据库放在临时目录中，结束后连同 WAL 文件一起删除
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'data.db')
+        fill(path, rows)
+        targets = [f'BV{(i * 7919) % (rows * 2):010d}' for i in range(queries)]
+
+        latencies = []
+        for bvid in targets:
+            begin = time.perf_counter()
+            old_commit_exists(path, bvid)
+            latencies.append(time.perf_counter() - begin)
+        report(f'old ({rows} rows)', latencies)
+
+        db.db_file = path
+        db.init()
+        latencies = []
+        for bvid in targets:
+            begin = time.perf_counter()
+            await db.commit_exists(bvid)
+            latencies.append(time.perf_counter() - begin)
+        report(f'new ({rows} rows)', latencies)
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(db.commit_exists(x) for x in targets))
+        elapsed = time.perf_counter() - begin
+        print(f'{"new, concurrent":<28} {queries / elapsed:.0f} checks/s')
+        db.close()
+
+
+if __name__ == '__main__':
+    from loguru import logger
+    logger.remove()
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    asyncio.run(main(rows, queries))
@@ -0,0 +1,465 @@
+"""
+端到端吞吐基准：用进程内的假上游驱动真实的 run_per_loop / process_video_ass / process_video
+
+假上游：B 站动态、视频信息、字幕、playurl 和 CDN，空降助手 API，OpenAI 兼容的流式接口，Gemini 文件和生成接口
+延迟和失败率可以配置；输出吞吐、各阶段 p50/p99、内存和临时文件占用的峰值
+注意：失败会触发 @retry 的真实等待时间
+
+用法：python -m bench.e2e_bench [--ass 200] [--video 20] [--latency 0.05] [--llm-latency 0.5] [--failure-rate 0]
+--instances N 同时启动 N 个进程处理同一批视频，通过共享的 SQLite 领取表（[claims]）分工，对比单实例的耗时
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """
+[gemini]
+api_key_list=['bench-key-0', 'bench-key-1']
+model='gemini-bench'
+proxy=''
+rpm=0
+tpm=0
+file_timeout=600
+
+[sponsor]
+api='https://sponsor.bench'
+private_id='bench'
+user_agent='bench'
+
+[running]
+mode='{mode}'
+min_second=60
+max_second=1800
+media_mode='audio'
+
+[ass]
+api_key='bench'
+base_url='https://openai.bench/v1'
+use_model='bench-model'
+stream=true
+thinking=false
+
+[jobs]
+batch_size={batch_size}
+busy_retry_delay=0.2
+
+[claims]
+backend='{claims_backend}'
+path='{claims_path}'
+worker_id='{worker}'
+
+[metrics]
+enabled=true
+
+[workspace]
+quota_mb={quota_mb}
+
+[prescreen]
+enabled={prescreen}
+"""
+
+
+class Upstreams:
+    """假上游共用的延迟和失败注入"""
+
+    def __init__(self, latency: float, llm_latency: float, failure_rate: float, media_kb: int,
+                 gemini_latency: float, gemini_processing: float, ad_ratio: float):
+        self.latency = latency
+        self.llm_latency = llm_latency
+        self.failure_rate = failure_rate
+        self.media_kb = media_kb
+        self.gemini_latency = gemini_latency
+        self.gemini_processing = gemini_processing
+        self.ad_ratio = ad_ratio
+        self.requests: dict[str, int] = {}
+        self.rand = random.Random(42)
+
+    async def delay(self, name: str, base: float = None):
+        self.requests[name] = self.requests.get(name, 0) + 1
+        base = self.latency if base is None else base
+        if base:
+            await asyncio.sleep(base * self.rand.uniform(0.5, 1.5))
+
+    def should_fail(self) -> bool:
+        return self.failure_rate > 0 and self.rand.random() < self.failure_rate
+
+    # ---------- B 站 ----------
+    def video_info(self, bvid: str) -> dict:
+        rand = random.Random(bvid)
+        return {'title': f'测试视频 {bvid}', 'pages': [{'cid': rand.randint(1, 10 ** 9), 'duration': rand.randint(120, 900)}]}
+
+    def subtitle_body(self, bvid: str) -> list:
+        rand = random.Random(bvid)
+        duration = self.video_info(bvid)['pages'][0]['duration']
+        words = ['今天', '我们', '来看看', '这个', '东西', '其实', '非常', '好用', '大家', '可以', '试一试', '然后']
+        body, t = [], 0.0
+        while t < duration:
+            length = rand.uniform(1.5, 4)
+            body.append({'from': round(t, 2), 'to': round(t + length, 2),
+                         'content': ''.join(rand.choice(words) for _ in range(rand.randint(3, 8)))})
+            t += length + rand.uniform(0, 0.5)
+        # 有广告的视频在中间插入一句口播，供关键词预筛命中
+        if rand.random() < self.ad_ratio:
+            body[len(body) // 2]['content'] = '本期视频由某某赞助，优惠码在评论区置顶'
+        return body
+
+    def feed_item(self, bvid: str, up_id: int) -> dict:
+        return {
+            'id_str': str(10 ** 18 + up_id),
+            'type': 'DYNAMIC_TYPE_AV',
+            'modules': {
+                'module_author': {'mid': up_id, 'name': f'up{up_id}', 'pub_ts': int(time.time())},
+                'module_dynamic': {'major': {'archive': {'bvid': bvid}}},
+            },
+        }
+
+    async def http_handler(self, request: httpx.Request) -> httpx.Response:
+        host, path = request.url.host, request.url.path
+        if host == 'subtitle.bench':
+            await self.delay('subtitle')
+            return httpx.Response(200, json={'body': self.subtitle_body(path.strip('/').split('.')[0])})
+        if host == 'api.bilibili.com' and path == '/x/player/playurl':
+            await self.delay('playurl')
+            bvid = request.url.params['bvid']
+            return httpx.Response(200, json={'code': 0, 'data': {'dash': {
+                'video': [{'id': 16, 'codecid': 7, 'bandwidth': 100000, 'baseUrl': f'https://cdn.bench/{bvid}.m4s'}],
+                'audio': [{'id': 30216, 'bandwidth': 64000, 'baseUrl': f'https://cdn.bench/{bvid}.m4a'}],
+            }}})
+        if host == 'cdn.bench':
+            await self.delay('cdn')
+            size = max(1, self.media_kb // 64) * 64 * 1024
+            return httpx.Response(200, headers={'content-length': str(size)}, content=self._media_chunks())
+        if host == 'sponsor.bench':
+            await self.delay('sponsor')
+            if request.method == 'POST':
+                if self.should_fail():
+                    return httpx.Response(500, text='bench failure')
+                return httpx.Response(200, text='OK')
+            return httpx.Response(404, text='Not Found')
+        if host == 'openai.bench':
+            return await self._chat_completions(request)
+        return httpx.Response(404)
+
+    async def _media_chunks(self):
+        chunk = b'\0' * 64 * 1024
+        for _ in range(max(1, self.media_kb // 64)):
+            yield chunk
+            await asyncio.sleep(0)
+
+    # ---------- OpenAI 兼容接口 ----------
+    def _segments(self, seed: str) -> dict:
+        rand = random.Random(seed)
+        if rand.random() >= self.ad_ratio:
+            return {'segments': []}
+        start = rand.randint(30, 100)
+        return {'segments': [{'start': start, 'end': start + 40, 'reason': '口播广告', 'actionType': 'sponsor'}]}
+
+    async def _chat_completions(self, request: httpx.Request) -> httpx.Response:
+        await self.delay('openai', self.llm_latency)
+        if self.should_fail():
+            return httpx.Response(503, json={'error': {'message': 'bench failure'}})
+        body = json.loads(request.content)
+        prompt = body['messages'][-1]['content']
+        content = json.dumps(self._segments(prompt), ensure_ascii=False)
+
+        async def events():
+            for i in range(0, len(content), 16):
+                delta = {'id': 'bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                         'choices': [{'index': 0, 'delta': {'content': content[i:i + 16]}, 'finish_reason': None}]}
+                yield f'data: {json.dumps(delta)}\n\n'.encode()
+                await asyncio.sleep(0.005)
+            usage = {'id': 'bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'], 'choices': [],
+                     'usage': {'prompt_tokens': len(prompt), 'completion_tokens': len(content) // 2,
+                               'total_tokens': len(prompt) + len(content) // 2}}
+            yield f'data: {json.dumps(usage)}\n\n'.encode()
+            yield b'data: [DONE]\n\n'
+
+        return httpx.Response(200, headers={'content-type': 'text/event-stream'}, content=events())
+
+
+class FakeGeminiFiles:
+    def __init__(self, upstreams: Upstreams):
+        self.upstreams = upstreams
+        self.files = {}
+        self.count = 0
+
+    def _view(self, name):
+        file, ready_at = self.files[name]
+        state = 'ACTIVE' if time.monotonic() >= ready_at else 'PROCESSING'
+        return SimpleNamespace(**{**file.__dict__, 'state': SimpleNamespace(name=state)})
+
+    async def upload(self, file, config=None):
+        await self.upstreams.delay('gemini_upload', self.upstreams.gemini_latency)
+        self.count += 1
+        name = f'files/bench{self.count}'
+        handle = SimpleNamespace(name=name, uri=f'https://gemini.bench/{name}', mime_type=(config or {}).get('mime_type'),
+                                 size_bytes=os.path.getsize(file), expiration_time=None)
+        self.files[name] = (handle, time.monotonic() + self.upstreams.gemini_processing)
+        return self._view(name)
+
+    async def get(self, name):
+        await self.upstreams.delay('gemini_files')
+        return self._view(name)
+
+    async def list(self, config=None):
+        await self.upstreams.delay('gemini_files')
+        return SimpleNamespace(page=[self._view(x) for x in self.files])
+
+    async def delete(self, name):
+        self.files.pop(name, None)
+
+
+class FakeGeminiModels:
+    def __init__(self, upstreams: Upstreams, ad_model):
+        self.upstreams = upstreams
+        self.ad_model = ad_model
+
+    async def generate_content(self, model, contents, config=None):
+        await self.upstreams.delay('gemini_generate', self.upstreams.llm_latency)
+        if self.upstreams.should_fail():
+            raise Exception('bench failure')
+        rand = random.Random(contents[0].name)
+        if rand.random() < self.upstreams.ad_ratio:
+            begin = rand.randint(30, 100)
+            parsed = self.ad_model(haveAd=True, beginTime=begin, endTime=begin + 40)
+        else:
+            parsed = self.ad_model(haveAd=False, beginTime=0, endTime=0)
+        usage = SimpleNamespace(total_token_count=1200, prompt_token_count=1150, candidates_token_count=50)
+        return SimpleNamespace(text=parsed.model_dump_json(), parsed=parsed, usage_metadata=usage)
+
+
+def fake_gemini_client(upstreams: Upstreams, ad_model):
+    return SimpleNamespace(aio=SimpleNamespace(files=FakeGeminiFiles(upstreams),
+                                               models=FakeGeminiModels(upstreams, ad_model)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def current_rss_kb() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+async def sample_resources(tmp_dir: str, peaks: dict, interval: float = 0.02):
+    while True:
+        peaks['rss_kb'] = max(peaks['rss_kb'], current_rss_kb())
+        peaks['disk_bytes'] = max(peaks['disk_bytes'], dir_size(tmp_dir))
+        await asyncio.sleep(interval)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='sponsor-bench-')
+    media_dir = os.path.join(workdir, 'media')
+    os.makedirs(media_dir)
+    with open(os.path.join(workdir, 'project.toml'), 'w') as f:
+        f.write(CONFIG.replace('{batch_size}', str(args.ass + args.video)).replace('{quota_mb}', str(args.quota_mb))
+                .replace('{mode}', args.mode).replace('{prescreen}', str(args.prescreen).lower())
+                .replace('{claims_backend}', 'sqlite' if args.claims_db else 'memory')
+                .replace('{claims_path}', args.claims_db).replace('{worker}', args.worker))
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    # 下载的临时文件都写到这个目录，便于统计磁盘占用
+    tempfile.tempdir = media_dir
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    upstreams = Upstreams(args.latency, args.llm_latency, args.failure_rate, args.media_kb,
+                          args.gemini_latency, args.gemini_processing, args.ad_ratio)
+
+    # 在其他模块导入之前替换 http 客户端和指标记录，使它们拿到的都是替换后的对象
+    from src import http_clients, metrics
+    transport = httpx.MockTransport(upstreams.http_handler)
+    for name in http_clients.UPSTREAMS:
+        http_clients._clients[name] = httpx.AsyncClient(transport=transport)
+
+    samples: dict[str, list[float]] = {}
+    original_observe = metrics.observe
+
+    def observe(name, value, **labels):
+        key = name if not labels else f'{name}{{{",".join(f"{k}={v}" for k, v in sorted(labels.items()))}}}'
+        samples.setdefault(key, []).append(value)
+        original_observe(name, value, **labels)
+
+    metrics.observe = observe
+
+    from bilibili_api import Credential, dynamic, video
+    from bilibili_api.utils.aid_bvid_transformer import aid2bvid
+    from src import credential, db, main, router
+    from src.config import get_gemini_scheduler
+    from src.jobs import add_job, STATES, DONE, SKIPPED, FAILED
+    from src.process_ad import AdModel
+
+    async def get_info(self):
+        await upstreams.delay('video_info')
+        return upstreams.video_info(self.get_bvid())
+
+    async def get_subtitle(self, cid=None):
+        await upstreams.delay('player')
+        if self.get_bvid() in no_subtitle:
+            return {'subtitles': []}
+        return {'subtitles': [{'lan': 'ai-zh', 'lan_doc': '中文（自动生成）',
+                               'subtitle_url': f'//subtitle.bench/{self.get_bvid()}.json'}]}
+
+    ass_ids = [aid2bvid(10 ** 8 + i) for i in range(args.ass)]
+    feed_items = [upstreams.feed_item(bvid, i) for i, bvid in enumerate(ass_ids)]
+    # 没有字幕的视频：字幕模式下跳过，自动模式下转为视频模式
+    no_subtitle = set(ass_ids[:int(len(ass_ids) * args.no_subtitle_ratio)])
+
+    async def get_dynamic_page_info(credential, dynamic_type=None, offset=None, **kwargs):
+        await upstreams.delay('feed')
+        return {'items': feed_items, 'offset': None, 'has_more': False}
+
+    async def validate():
+        return credential.credential
+
+    video.Video.get_info = get_info
+    video.Video.get_subtitle = get_subtitle
+    dynamic.get_dynamic_page_info = get_dynamic_page_info
+    main.validate = validate
+    credential.credential = Credential(sessdata='bench', bili_jct='bench')
+    for key in get_gemini_scheduler().keys:
+        key.client = fake_gemini_client(upstreams, AdModel)
+
+    latencies: dict[str, list[float]] = {}
+    for mode, handler in list(router.HANDLERS.items()):
+        async def timed(job, handler=handler, mode=mode):
+            begin = time.monotonic()
+            try:
+                await handler(job)
+            finally:
+                latencies.setdefault(mode, []).append(time.monotonic() - begin)
+        router.HANDLERS[mode] = timed
+
+    db.init()
+    for i in range(args.video):
+        await add_job(aid2bvid(2 * 10 ** 8 + i), 10 ** 6 + i, f'up{i}', 'video')
+
+    peaks = {'rss_kb': current_rss_kb(), 'disk_bytes': 0}
+    baseline_rss = peaks['rss_kb']
+    sampler = asyncio.create_task(sample_resources(media_dir, peaks))
+
+    begin = time.monotonic()
+    cycles = 0
+    while True:
+        cycles += 1
+        await main.run_per_loop()
+        counts = await db.count_jobs()
+        pending = sum(v for k, v in counts.items() if k not in (DONE, SKIPPED, FAILED))
+        if not pending or cycles >= args.max_cycles:
+            break
+        if args.claims_db:
+            # 等其他实例处理完正在处理的视频
+            await asyncio.sleep(0.2)
+    elapsed = time.monotonic() - begin
+    sampler.cancel()
+
+    finished = sum(counts.get(x, 0) for x in (DONE, SKIPPED))
+    print(f'\n动态中的视频 {args.ass} 个（{args.mode} 模式，{len(no_subtitle)} 个没有字幕）+ {args.video} 个视频模式，'
+          f'{cycles} 轮，耗时 {elapsed:.2f} 秒')
+    print(f'完成 {finished} 个，吞吐 {finished / elapsed * 3600:.0f} 个/小时')
+    print('任务状态：' + ', '.join(f'{x}={counts[x]}' for x in STATES if counts.get(x)))
+    print(f'内存峰值 {peaks["rss_kb"] / 1024:.1f}MB（基线 {baseline_rss / 1024:.1f}MB），'
+          f'临时文件峰值 {peaks["disk_bytes"] / 1024 / 1024:.1f}MB')
+    routes = {dict(labels)['mode'] + '/' + dict(labels)['reason']: int(v)
+              for (name, labels), v in metrics._counters.items() if name == 'route_decisions_total'}
+    if routes:
+        print('自动模式选择：' + ', '.join(f'{k}={v}' for k, v in sorted(routes.items())))
+    print('上游请求数：' + ', '.join(f'{k}={v}' for k, v in sorted(upstreams.requests.items())))
+
+    print(f'\n{"阶段":<48}{"次数":>8}{"p50":>10}{"p99":>10}{"max":>10}')
+    rows = {f'video{{mode={k}}}': v for k, v in latencies.items()}
+    rows.update(samples)
+    for name in sorted(rows):
+        values = rows[name]
+        print(f'{name:<48}{len(values):>8}{statistics.median(values) * 1000:>8.1f}ms'
+              f'{percentile(values, 0.99) * 1000:>8.1f}ms{max(values) * 1000:>8.1f}ms')
+
+    await http_clients.close_all()
+    db.close()
+    os.chdir(ROOT)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_instances(args):
+    """启动多个进程，共享同一个领取表，各自拉取同样的动态"""
+    shared = tempfile.mkdtemp(prefix='sponsor-bench-shared-')
+    claims_db = os.path.join(shared, 'claims.db')
+    begin = time.monotonic()
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), *sys.argv[1:], '--instances', '1',
+                                   '--claims-db', claims_db, '--worker', f'bench{i}',
+                                   '--max-cycles', str(max(args.max_cycles, 200))],
+                                  stdout=subprocess.PIPE, text=True)
+                 for i in range(args.instances)]
+    outputs = [p.communicate()[0] for p in processes]
+    elapsed = time.monotonic() - begin
+    for i, out in enumerate(outputs):
+        print(f'\n========== 实例 bench{i} ==========')
+        print(out.strip())
+    total = args.ass + args.video
+    print(f'\n{args.instances} 个实例共处理 {total} 个视频，总耗时 {elapsed:.2f} 秒（包括进程启动），'
+          f'吞吐 {total / elapsed * 3600:.0f} 个/小时')
+    shutil.rmtree(shared, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端吞吐基准')
+    parser.add_argument('--ass', type=int, default=200, help='动态中的视频数，按 --mode 处理')
+    parser.add_argument('--mode', default='ass', choices=['ass', 'video', 'auto'], help='动态中的视频使用的处理模式')
+    parser.add_argument('--no-subtitle-ratio', type=float, default=0, help='动态中没有字幕的视频比例')
+    parser.add_argument('--video', type=int, default=20, help='视频模式视频数（直接写入任务表）')
+    parser.add_argument('--latency', type=float, default=0.05, help='B 站、空降助手等普通接口的平均延迟（秒）')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='大模型首 token / Gemini 生成的平均延迟（秒）')
+    parser.add_argument('--gemini-latency', type=float, default=0.2, help='Gemini 上传的平均延迟（秒）')
+    parser.add_argument('--gemini-processing', type=float, default=0, help='Gemini 文件处理耗时（秒），大于 0 时会走文件状态轮询')
+    parser.add_argument('--failure-rate', type=float, default=0, help='大模型和提交接口的失败率')
+    parser.add_argument('--ad-ratio', type=float, default=0.3, help='有广告的视频比例')
+    parser.add_argument('--media-kb', type=int, default=2048, help='视频模式下载的文件大小（KB）')
+    parser.add_argument('--quota-mb', type=int, default=2048, help='下载工作目录的磁盘配额（MB）')
+    parser.add_argument('--prescreen', action='store_true', help='开启字幕关键词预筛')
+    parser.add_argument('--max-cycles', type=int, default=5, help='最多执行多少轮 run_per_loop')
+    parser.add_argument('--instances', type=int, default=1, help='同时运行的实例数')
+    parser.add_argument('--claims-db', default='', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', default='bench', help=argparse.SUPPRESS)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    if args.instances > 1:
+        run_instances(args)
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
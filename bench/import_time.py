@@ -0,0 +1,61 @@
+"""
+启动耗时和常驻内存基准
+
+在新的子进程中导入 src.main（即 main.py 启动时加载的全部模块），统计耗时、内存和是否加载了 Gemini / OpenAI SDK
+再对比第一次创建 Gemini 客户端（视频模式）之后的耗时和内存
+用法：python -m bench.import_time [次数]
+"""
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = """
+import json, resource, sys, time
+begin = time.perf_counter()
+import src.main
+imported = time.perf_counter() - begin
+result = {'import': imported}
+if sys.argv[1] == 'video':
+    from src.config import get_gemini_scheduler
+    begin = time.perf_counter()
+    get_gemini_scheduler()
+    result['gemini'] = time.perf_counter() - begin
+result['rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+result['genai'] = 'google.genai' in sys.modules
+result['openai'] = 'openai' in sys.modules
+print(json.dumps(result))
+"""
+
+
+def measure(workdir: str, mode: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.run([sys.executable, '-c', SCRIPT, mode], cwd=workdir, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    times = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    workdir = tempfile.mkdtemp(prefix='sponsor-import-')
+    shutil.copy(os.path.join(ROOT, 'project.example.toml'), os.path.join(workdir, 'project.toml'))
+    try:
+        for mode in ('ass', 'video'):
+            results = [measure(workdir, mode) for _ in range(times)]
+            line = (f'{mode:<6} import src.main {statistics.median(x["import"] for x in results) * 1000:.0f}ms'
+                    f'  rss {statistics.median(x["rss_mb"] for x in results):.1f}MB')
+            if mode == 'video':
+                line += f'  创建 Gemini 客户端 {statistics.median(x["gemini"] for x in results) * 1000:.0f}ms'
+            line += f'  google.genai 已加载={results[0]["genai"]}  openai 已加载={results[0]["openai"]}'
+            print(line)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+字幕关键词预筛的准确率和召回率
+
+用 commit_history 中大模型已经给出的结论（haveAd 以及广告片段）作为标准答案，
+和字幕模式保存的样本（subtitle_samples，大模型分析过的完整字幕，数量见 prescreen.sample_max_rows）一起，评估当前配置的关键词：
+- 视频级别：预筛认为"可能有广告"的准确率、召回率，以及可以省掉的大模型调用比例
+- 片段级别：有广告的视频中，广告片段落在候选时间段内的比例，以及节选后发给大模型的 token 比例
+用法（在项目目录执行，读取 project.toml 中的 [prescreen] 配置）：python -m bench.prescreen_eval [data.db]
+"""
+import json
+import sqlite3
+import sys
+import zlib
+
+from src.prescreen import prescreen
+from src.subtitle import estimate_tokens
+
+
+def load(path: str):
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    rows = conn.execute('''select c.bvid, c.json_data, s.title, s.body from commit_history c
+                           join subtitle_samples s on s.bvid = c.bvid''').fetchall()
+    conn.close()
+    for bvid, commit, title, body in rows:
+        commit = json.loads(commit)
+        # 预筛直接判定的视频没有经过大模型，不能作为标准答案
+        if commit.get('prescreen'):
+            continue
+        yield bvid, commit, {'title': title, 'body': json.loads(zlib.decompress(body))}
+
+
+def overlap(segment, regions) -> bool:
+    """广告片段至少一半落在候选时间段内"""
+    start, end = segment['start'], segment['end']
+    covered = sum(max(0.0, min(end, b) - max(start, a)) for a, b in regions)
+    return covered >= (end - start) / 2
+
+
+def main(path: str):
+    tp = fp = fn = tn = 0
+    segments = covered = 0
+    tokens_all = tokens_sent = 0
+    missed = []
+    for bvid, commit, data in load(path):
+        body = data['body']
+        screen = prescreen.screen(body)
+        have_ad = bool(commit.get('haveAd'))
+        if have_ad and not screen.clean:
+            tp += 1
+        elif have_ad:
+            fn += 1
+            missed.append((bvid, data.get('title', '')))
+        elif not screen.clean:
+            fp += 1
+        else:
+            tn += 1
+
+        if have_ad:
+            for seg in commit.get('ad_results', []):
+                segments += 1
+                covered += overlap(seg, screen.regions)
+        tokens = [estimate_tokens(x['content']) for x in body]
+        tokens_all += sum(tokens)
+        if not screen.clean:
+            tokens_sent += sum(estimate_tokens(x['content']) for x in prescreen.select(body, screen.regions))
+
+    total = tp + fp + fn + tn
+    if not total:
+        print('没有可以评估的数据（需要字幕模式处理过、保存了字幕样本的视频）')
+        return
+    print(f'视频 {total} 个，有广告 {tp + fn} 个')
+    print(f'准确率 {tp / max(1, tp + fp):.3f}，召回率 {tp / max(1, tp + fn):.3f}（TP={tp} FP={fp} FN={fn} TN={tn}）')
+    print(f'不调用大模型的视频 {fn + tn} 个，占 {(fn + tn) / total:.1%}，其中漏掉有广告的视频 {fn} 个')
+    if segments:
+        print(f'广告片段 {segments} 个，落在候选时间段内 {covered} 个，占 {covered / segments:.1%}')
+    if tokens_all:
+        print(f'发给大模型的字幕 token {tokens_sent}/{tokens_all}，占 {tokens_sent / tokens_all:.1%}')
+    for bvid, title in missed[:20]:
+        print(f'  漏掉 {bvid} {title}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'data.db')
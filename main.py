@@ -2,9 +2,13 @@ import asyncio
 import sys
 
 from loguru import logger
-from src.credential import init as init_credential
-from src.db import init as init_db
+from src.claims import claim_store
+from src.credential import init as init_credential, close as close_credential
+from src.db import init as init_db, close as close_db
+from src.http_clients import close_all as close_http_clients
+from src import metrics
 from src.main import run_per_loop
+from src.scheduler import poll_scheduler
 
 
 logger.remove()
@@ -17,14 +21,17 @@ logger.add(
 async def main():
     init_db()
     await init_credential()
-    while True:
-        try:
-            await run_per_loop()
-            logger.info('------------------------')
-        except Exception as e:
-            logger.exception(f'系统执行异常: {e}')
-
-        await asyncio.sleep(30 * 60)
+    # 开启指标后同时提供 POST /trigger，立即开始下一轮
+    server = await metrics.start_server({'/trigger': poll_scheduler.trigger})
+    try:
+        await poll_scheduler.run(run_per_loop)
+    finally:
+        if server is not None:
+            server.close()
+        await close_credential()
+        await close_http_clients()
+        await claim_store.close()
+        close_db()
 
 
 if __name__ == "__main__":
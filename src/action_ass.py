@@ -5,6 +5,7 @@ import json_repair
 from loguru import logger
 from pydantic import BaseModel, Field, ValidationError
 
+from src.config import ass_conf
 from src.openapi_client import create_request
 
 # 严格保留你要求的 actionType 取值
@@ -31,6 +32,9 @@ class VideoSegment(BaseModel):
 class VideoAnalysisResponse(BaseModel):
     segments: List[VideoSegment]
 
+# 修改提示词或返回结构时需要升级版本号，使旧的缓存失效
+PROMPT_VERSION = 'ass-v1'
+
 # 提取 JSON Schema 字符串，用于注入 Prompt
 JSON_SCHEMA_STR = VideoAnalysisResponse.model_json_schema()
 
@@ -69,7 +73,9 @@ async def get_video_analysis(title: str, subtitle_text: str):
     history = [{"role": "user", "content": prompt}]
 
     # --- 第一次尝试 ---
-    response_content = await create_request(prompt, history=history)
+    # 第一次可以按配置关闭思考以降低耗时；只需要一个 JSON 对象，收到后立即结束
+    response_content = await create_request(prompt, history=history, thinking=ass_conf.first_pass_thinking,
+                                            stop_on_json=True)
 
     logger.debug(f"第一次尝试，返回： {response_content}")
 
@@ -89,13 +95,14 @@ async def get_video_analysis(title: str, subtitle_text: str):
         history.append({"role": "assistant", "content": response_content})
         history.append({"role": "user", "content": retry_prompt})
 
-        fixed_content = await create_request(retry_prompt, history=history)
+        fixed_content = await create_request(retry_prompt, history=history, stop_on_json=True)
 
         try:
             fixed_json = json_repair.loads(fixed_content)
             validated_res = VideoAnalysisResponse.model_validate(fixed_json)
-        except:
-            logger.error("二次修正依然失败，返回空结果。")
-            return {"segments": []}
+        except Exception as e:
+            # 不能当作没有广告：抛出异常，结果不会写入分析缓存，之后重试时重新分析
+            logger.error("二次修正依然失败。")
+            raise Exception('大模型返回的结果无法解析') from e
 
     return validated_res.model_dump()
\ No newline at end of file
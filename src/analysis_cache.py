@@ -0,0 +1,44 @@
+"""AI 分析结果缓存：相同的模型、提示词版本和输入内容只调用一次大模型"""
+import hashlib
+
+from loguru import logger
+
+from src import metrics
+from src.config import settings
+from src.db import get_analysis, set_analysis
+
+cache_conf = settings.cache
+
+_stats = {'hits': 0, 'misses': 0}
+
+
+def make_key(model: str, prompt_version: str, content: str) -> str:
+    return hashlib.sha256(f'{model}\n{prompt_version}\n{content}'.encode()).hexdigest()
+
+
+def stats() -> dict:
+    return dict(_stats)
+
+
+async def cached(model: str, prompt_version: str, content: str, producer):
+    """
+    命中缓存直接返回，否则调用 producer() 得到结果并写入缓存
+    结果需要能被 json 序列化
+    """
+    if not cache_conf.analysis_enabled:
+        return await producer()
+
+    key = make_key(model, prompt_version, content)
+    max_age = cache_conf.analysis_max_age_days * 86400
+    result = await get_analysis(key, max_age)
+    if result is not None:
+        _stats['hits'] += 1
+        metrics.inc('cache_requests_total', cache='analysis', result='hit')
+        logger.info(f'命中分析缓存 {key[:12]}，跳过大模型调用')
+        return result
+
+    _stats['misses'] += 1
+    metrics.inc('cache_requests_total', cache='analysis', result='miss')
+    result = await producer()
+    await set_analysis(key, model, result, cache_conf.analysis_max_rows, max_age)
+    return result
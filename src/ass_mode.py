@@ -1,19 +1,22 @@
 """使用字幕处理视频广告"""
-import pprint
+import asyncio
 
-import httpx
-import json_repair
 from bilibili_api import video
 from loguru import logger
-from openai import AsyncOpenAI
 
-from src.action_ass import get_video_analysis
-from src.config import conf, ass_conf
-from src.credential import validate, get_credential
-from src.db import insert_commit
-from src.openapi_client import create_request
+from src import metrics, prescreen
+from src.action_ass import get_video_analysis, PROMPT_VERSION
+from src.analysis_cache import cached
+from src.config import ass_conf, sponsor_conf
+from src.credential import get_credential
+from src.db import insert_commit, save_subtitle_sample
+from src.http_clients import get_client
+from src.jobs import Job, DISCOVERED, MEDIA_FETCHED, ANALYZED, SUBMITTED, SKIPPED
+from src.pipeline import stage
 from src.process_ad import check_exist
-from src.retry import retry
+from src.retry import retry, circuit, HttpError
+from src.sponsor import segment_lookup
+from src.subtitle import split_windows, merge_segments, compact, format_compact_line, snap_segments, FILLER_WORDS
 
 
 async def get_subtitle_body(subtitle_data):
@@ -43,107 +46,193 @@ async def get_subtitle_body(subtitle_data):
     if url.startswith('//'):
         url = 'https:' + url
 
-    async with httpx.AsyncClient() as http_client:
-        response = await http_client.get(url)
-        if response.status_code == 200:
-            return response.json().get('body', [])
+    with metrics.timer('stage_seconds', stage='subtitle_download'):
+        response = await get_client('subtitle').get(url)
+    if response.status_code == 200:
+        metrics.inc('download_bytes_total', len(response.content), kind='subtitle')
+        return response.json().get('body', [])
     return None
 
 
-client = AsyncOpenAI(api_key=ass_conf['api_key'], base_url=ass_conf['base_url'])
-
 
 async def detect_ads_with_llm(title, subtitle_body):
     """
     调用大模型分析字幕中的广告内容
+    先压缩字幕减少 token，超过预算时再按重叠的时间窗口切分后并发分析，最后合并结果
     """
-    # 1. 简化字幕，减少 Token 消耗 (只保留时间戳和内容)
-    formatted_subtitles = []
-    for item in subtitle_body:
-        formatted_subtitles.append(f"[{item['from']} - {item['to']}] {item['content']}")
+    window_tokens = ass_conf.window_tokens
+    precision = ass_conf.timestamp_precision
+    spans, stats = compact(subtitle_body, ass_conf.compact_budget or window_tokens, precision,
+                           filler_words=set(FILLER_WORDS if ass_conf.filler_words is None else ass_conf.filler_words))
+    logger.info(f"字幕压缩：{stats['lines']} 行 -> {stats['spans']} 段，"
+                f"token {stats['tokens_before']} -> {stats['tokens_after']}，节省 {round(stats['saved_ratio'] * 100, 1)}%")
 
-    subtitle_text = "\n".join(formatted_subtitles)
+    # 显示的时间最多被取整 1 个单位，对齐时在这个范围内寻找原始时间
+    tolerance = 10 ** -precision
 
-    return await get_video_analysis(title, subtitle_text)
+    def formatter(item):
+        return format_compact_line(item, precision)
 
-http_client = httpx.AsyncClient()
-@retry(delay=30)
-async def process_video_ass(video_id: str, up_id: int, up_name: str):
-    logger.info(f'video id: {video_id}')
-    if await check_exist(video_id):
-        logger.info(f'视频已经处理过了，跳过.')
-        return
-
-    # 1. 获取视频信息
-    credential = get_credential()
-    v = video.Video(bvid=video_id, credential=credential)
-    video_info =  await  v.get_info()
-    title = video_info['title']
-
-    # 2. 获取字幕
-    cid = video_info['pages'][0]['cid']
-    duration = video_info['pages'][0]['duration']
-    if duration >= 600:
-        logger.info(f'视频时长超过10分钟，跳过.')
-        return
-
-    raw_subtitle_res = await v.get_subtitle(cid)
-
-    # 3. 下载并解析字幕 Body
-    logger.info(f"正在下载视频字幕...")
-    body = await get_subtitle_body(raw_subtitle_res)
-
-    if not body:
-        logger.info("未找到有效字幕内容。")
-        return
-
-    # 4. 调用 AI 识别
-    ad_results_llm = await detect_ads_with_llm(title, body)
-
-    logger.debug(f'识别结果： {ad_results_llm}')
-    ad_results = ad_results_llm['segments']
-    if not ad_results:
-        logger.info("未找到广告内容。")
-        insert_commit(video_id, {
-            'haveAd': False
-        }, up_id, up_name)
-        return
-    sponsor_conf = conf['sponsor']
-    payload = {
-        'videoID': video_id,
-        'userID': sponsor_conf['private_id'],
-        'userAgent': sponsor_conf['user_agent'],
-        'videoDuration': video_info['pages'][0]['duration'],
+    windows = split_windows(spans, window_tokens, ass_conf.window_overlap_seconds, formatter)
+    if len(windows) <= 1:
+        res = await _analyze(title, _format_subtitles(spans, formatter))
+        return {'segments': snap_segments(res['segments'], subtitle_body, tolerance)}
+
+    logger.info(f'字幕较长，切分为 {len(windows)} 个窗口并发分析')
+    semaphore = asyncio.Semaphore(ass_conf.window_concurrency)
+
+    async def analyze(i, window):
+        async with semaphore:
+            part_title = f'{title}（第 {i + 1}/{len(windows)} 段，{int(window[0]["from"])}秒 - {int(window[-1]["to"]) + 1}秒）'
+            return await _analyze(part_title, _format_subtitles(window, formatter))
+
+    results = await asyncio.gather(*(analyze(i, w) for i, w in enumerate(windows)))
+    segments = [seg for res in results for seg in res['segments']]
+    return {'segments': merge_segments(snap_segments(segments, subtitle_body, tolerance))}
+
+
+async def _analyze(title, subtitle_text):
+    # 以标题和压缩后的字幕作为缓存内容，重试时不会重复调用大模型
+    return await cached(ass_conf.use_model, PROMPT_VERSION, f'{title}\n{subtitle_text}',
+                        lambda: get_video_analysis(title, subtitle_text))
+
+
+def _format_subtitles(spans, formatter):
+    # 简化字幕，减少 Token 消耗 (只保留时间戳和内容)
+    return "\n".join(formatter(item) for item in spans)
+
+def _build_payload(job: Job):
+    return {
+        'videoID': job.bvid,
+        'userID': sponsor_conf.private_id,
+        'userAgent': sponsor_conf.user_agent,
+        'videoDuration': job.data['duration'],
         'segments': [
             {
                 'segment': [seg['start'], seg['end']], # 映射 AI 的识别结果
                 'category': 'sponsor',
                 'actionType': seg['actionType']
-            } for seg in ad_results
+            } for seg in job.data['segments']
         ]
     }
 
-    # 提交之前再确认一下
-    if await check_exist(video_id):
-        logger.info(f'视频已经处理过了，跳过.')
-        return
-
-    logger.info(f'commit payload: {payload}')
-    # 提交片段
-    res = await http_client.post(f'{sponsor_conf['api']}/api/skipSegments', json=payload, timeout=60)
-
-
-    if not res.is_success:
-        raise Exception(f'提交片段失败 {res.text}')
 
-    logger.info(f'提交片段成功 {res.text}')
-
-    k = {
-        'ad_results': ad_results,
-        'haveAd': len(ad_results) > 0
-    }
-    k.update(payload)
-    k['userID'] = '******'
-    k['res'] = res.text
-
-    insert_commit(video_id, k, up_id, up_name)
+@retry(delay=30)
+async def process_video_ass(job: Job):
+    """按任务状态逐个阶段处理，每个阶段完成后保存检查点，重试或重启时从上次的阶段继续"""
+    video_id = job.bvid
+    logger.info(f'video id: {video_id}, state: {job.state}')
+
+    if job.state == DISCOVERED:
+        if await check_exist(video_id):
+            logger.info(f'视频已经处理过了，跳过.')
+            await job.finish(SKIPPED, '已处理过')
+            return
+
+        # 1. 获取视频信息
+        credential = get_credential()
+        v = video.Video(bvid=video_id, credential=credential)
+        async with stage('meta'), circuit('bilibili'):
+            video_info =  await  v.get_info()
+        title = video_info['title']
+
+        # 2. 获取字幕
+        cid = video_info['pages'][0]['cid']
+        duration = video_info['pages'][0]['duration']
+        max_duration = ass_conf.max_duration
+        if duration > max_duration:
+            logger.info(f'视频时长超过{max_duration}秒，跳过.')
+            await job.finish(SKIPPED, '时长超过限制')
+            return
+
+        async with stage('download'), circuit('bilibili'):
+            raw_subtitle_res = await v.get_subtitle(cid)
+
+            # 3. 下载并解析字幕 Body
+            logger.info(f"正在下载视频字幕...")
+            body = await get_subtitle_body(raw_subtitle_res)
+
+        if not body:
+            logger.info("未找到有效字幕内容。")
+            await job.finish(SKIPPED, '没有字幕')
+            return
+
+        await job.checkpoint(MEDIA_FETCHED, title=title, cid=cid, duration=duration, body=body)
+
+    if job.state == MEDIA_FETCHED:
+        title, body = job.data['title'], job.data['body']
+        # 先用关键词预筛，没有线索词的视频不调用大模型，有线索词时只分析候选片段
+        screen = prescreen.prescreen.screen(body) if prescreen.enabled else None
+        if screen is not None:
+            job.data['prescreen'] = {'hits': screen.hits, 'regions': screen.regions}
+
+        if screen is not None and screen.clean:
+            logger.info('字幕中没有广告线索词，不调用大模型')
+            metrics.inc('prescreen_total', result='clean')
+            await job.checkpoint(ANALYZED, segments=[])
+        else:
+            narrowed = False
+            if screen is not None:
+                selected = prescreen.prescreen.select(body, screen.regions)
+                narrowed = len(selected) < len(body)
+                metrics.inc('prescreen_total', result='narrowed' if narrowed else 'full')
+                if narrowed:
+                    logger.info(f'命中广告线索词 {screen.hits}，只分析其中 {len(selected)}/{len(body)} 行字幕')
+                    title = f'{title}（字幕节选，只包含可能有广告的片段）'
+                    body = selected
+
+            # 4. 调用 AI 识别
+            async with stage('analyze'):
+                ad_results_llm = await detect_ads_with_llm(title, body)
+
+            logger.debug(f'识别结果： {ad_results_llm}')
+            await job.checkpoint(ANALYZED, segments=ad_results_llm['segments'])
+            if not narrowed and prescreen.sample_max_rows:
+                # 完整字幕和大模型的结论留作评估预筛的样本（bench/prescreen_eval.py）
+                await save_subtitle_sample(video_id, title, body, prescreen.sample_max_rows)
+
+    if job.state == ANALYZED:
+        ad_results = job.data['segments']
+        if not ad_results:
+            logger.info("未找到广告内容。")
+            k = {'haveAd': False}
+            if job.data.get('prescreen', {}).get('regions') == []:
+                # 关键词预筛判定，没有调用大模型
+                k['prescreen'] = True
+            await insert_commit(video_id, k, job.up_id, job.up_name)
+            await job.finish()
+            return
+
+        payload = _build_payload(job)
+        async with stage('submit'):
+            # 提交之前再确认一下
+            if await check_exist(video_id, fresh=True):
+                logger.info(f'视频已经处理过了，跳过.')
+                await job.finish(SKIPPED, '已处理过')
+                return
+
+            logger.info(f'commit payload: {payload}')
+            # 提交片段
+            with metrics.timer('stage_seconds', stage='sponsor_post'):
+                async with circuit('sponsor'):
+                    res = await get_client('sponsor').post(f'{sponsor_conf.api}/api/skipSegments', json=payload, timeout=60)
+                    if not res.is_success:
+                        raise HttpError(res, '提交片段失败')
+
+        segment_lookup.mark(video_id)
+
+        logger.info(f'提交片段成功 {res.text}')
+        await job.checkpoint(SUBMITTED, res=res.text)
+
+    if job.state == SUBMITTED:
+        ad_results = job.data['segments']
+        k = {
+            'ad_results': ad_results,
+            'haveAd': len(ad_results) > 0
+        }
+        k.update(_build_payload(job))
+        k['userID'] = '******'
+        k['res'] = job.data['res']
+
+        await insert_commit(video_id, k, job.up_id, job.up_name)
+        await job.finish()
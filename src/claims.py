@@ -0,0 +1,191 @@
+"""
+多实例部署时的视频领取：处理视频之前先登记领取，同一个视频同时只有一个实例在分析和提交
+- memory：只在本进程内协调，单实例部署时使用（默认）
+- sqlite：多个实例共享同一个 SQLite 文件（WAL），文件需要放在同一台机器上各容器都挂载的目录中，不支持网络文件系统
+领取带有租约，每个阶段完成时续期；实例退出或卡住导致租约过期后，其他实例可以接手
+处理完成的视频标记为 done，其他实例直接跳过，不再重复调用大模型
+"""
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from loguru import logger
+
+from src.config import settings
+from src.retry import PermanentError
+
+claims_conf = settings.claims
+
+# 领取结果
+CLAIMED = 'claimed'
+# 其他实例正在处理
+BUSY = 'busy'
+# 已经有实例处理完成
+DONE = 'done'
+
+
+@dataclass
+class Claim:
+    status: str
+    # BUSY 时为其他实例的租约到期时间
+    lease_until: float = 0
+    worker: str = ''
+
+
+class ClaimLostError(PermanentError):
+    """租约已经过期并被其他实例接手，当前实例不再继续处理"""
+    pass
+
+
+class MemoryClaimStore:
+    """进程内的领取表，完成的视频由本地任务表记录，这里不再保留"""
+
+    def __init__(self, worker: str, lease_seconds: float):
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self._leases: dict[str, tuple[str, float]] = {}
+
+    async def claim(self, bvid: str) -> Claim:
+        now = time.time()
+        worker, lease_until = self._leases.get(bvid, (self.worker, 0))
+        if worker != self.worker and lease_until >= now:
+            return Claim(BUSY, lease_until, worker)
+        self._leases[bvid] = (self.worker, now + self.lease_seconds)
+        return Claim(CLAIMED, now + self.lease_seconds, self.worker)
+
+    async def renew(self, bvid: str) -> bool:
+        worker, _ = self._leases.get(bvid, (self.worker, 0))
+        if worker != self.worker:
+            return False
+        self._leases[bvid] = (self.worker, time.time() + self.lease_seconds)
+        return True
+
+    async def complete(self, bvid: str):
+        self._drop(bvid)
+
+    async def release(self, bvid: str):
+        self._drop(bvid)
+
+    def _drop(self, bvid: str):
+        if self._leases.get(bvid, (None,))[0] == self.worker:
+            del self._leases[bvid]
+
+    async def close(self):
+        self._leases.clear()
+
+
+class SqliteClaimStore:
+    """多个实例共享的领取表，每个操作都是单条语句或单个事务，依靠 SQLite 的写锁保证原子性"""
+
+    def __init__(self, path: str, worker: str, lease_seconds: float, keep_days: float = 30):
+        self.path = path
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.keep_days = keep_days
+        self._conn: Optional[sqlite3.Connection] = None
+        # 和本地库一样，连接只在这一个线程里使用
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='claims')
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('pragma journal_mode = WAL')
+            conn.execute('pragma synchronous = NORMAL')
+            # 多个实例同时写入时等待对方的写锁
+            conn.execute('pragma busy_timeout = 10000')
+            with conn:
+                conn.execute("""create table if not exists claims
+                             (
+                                 bvid        text primary key,
+                                 worker      text,
+                                 state       text,
+                                 lease_until real,
+                                 updated_at  real
+                             )""")
+                removed = conn.execute("delete from claims where state = 'done' and updated_at < ?",
+                                       (time.time() - self.keep_days * 86400,)).rowcount
+            if removed:
+                logger.info(f'清理 {removed} 条过期的领取记录')
+            logger.info(f'使用共享领取表 {self.path}，实例 {self.worker}')
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _claim(self, bvid: str) -> Claim:
+        now = time.time()
+        conn = self._get_conn()
+        with conn:
+            # 没有记录、租约已过期或者本来就是自己领取的，才能领取成功
+            conn.execute('''insert into claims (bvid, worker, state, lease_until, updated_at) values (?, ?, 'claimed', ?, ?)
+                            on conflict(bvid) do update set worker = excluded.worker, lease_until = excluded.lease_until,
+                            updated_at = excluded.updated_at
+                            where claims.state = 'claimed' and (claims.lease_until < ? or claims.worker = excluded.worker)''',
+                         (bvid, self.worker, now + self.lease_seconds, now, now))
+            worker, state, lease_until = conn.execute('select worker, state, lease_until from claims where bvid = ?',
+                                                      (bvid,)).fetchone()
+        if state == DONE:
+            return Claim(DONE, 0, worker)
+        if worker != self.worker:
+            return Claim(BUSY, lease_until, worker)
+        return Claim(CLAIMED, lease_until, worker)
+
+    def _renew(self, bvid: str) -> bool:
+        now = time.time()
+        conn = self._get_conn()
+        with conn:
+            c = conn.execute('''update claims set lease_until = ?, updated_at = ?
+                                where bvid = ? and worker = ? and state = 'claimed' ''',
+                             (now + self.lease_seconds, now, bvid, self.worker))
+            return c.rowcount > 0
+
+    def _finish(self, bvid: str, state: str):
+        conn = self._get_conn()
+        with conn:
+            conn.execute('''update claims set state = ?, lease_until = 0, updated_at = ?
+                            where bvid = ? and worker = ? and state = 'claimed' ''',
+                         (state, time.time(), bvid, self.worker))
+
+    async def claim(self, bvid: str) -> Claim:
+        return await self._run(self._claim, bvid)
+
+    async def renew(self, bvid: str) -> bool:
+        return await self._run(self._renew, bvid)
+
+    async def complete(self, bvid: str):
+        """处理完成，其他实例不再处理这个视频"""
+        await self._run(self._finish, bvid, DONE)
+
+    async def release(self, bvid: str):
+        """放弃处理（失败或者不需要处理），租约立即过期，其他实例可以领取"""
+        await self._run(self._finish, bvid, CLAIMED)
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def worker_id() -> str:
+    """实例标识，默认为主机名（容器 id）加进程号，同一个容器重启后可以直接接手自己之前的租约"""
+    return claims_conf.worker_id or f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _create_store():
+    lease_seconds = claims_conf.lease_seconds or settings.jobs.visibility_timeout
+    if claims_conf.backend == 'sqlite':
+        return SqliteClaimStore(claims_conf.path, worker_id(), lease_seconds, claims_conf.keep_days)
+    return MemoryClaimStore(worker_id(), lease_seconds)
+
+
+claim_store = _create_store()
@@ -1,33 +1,308 @@
+"""
+读取并校验 project.toml
+Gemini 客户端等较重的 SDK 只在第一次用到时才导入和创建，只使用字幕模式时不会加载
+"""
+import hashlib
 import os.path
-import random
 import tomllib
+from typing import Annotated, Literal, Optional
 
-from google import genai
-from google.genai import types, Client
+from loguru import logger
+from pydantic import (BaseModel, ConfigDict, Field, NonNegativeFloat, NonNegativeInt, PositiveFloat, PositiveInt,
+                      ValidationError, field_validator, model_validator)
 
-if not os.path.exists("project.toml"):
-    raise Exception('找不到配置文件project.toml，请将文件project.example.toml复制一份，然后修改其中的配置！！')
+from src.key_scheduler import ApiKey, KeyScheduler
 
-with open("project.toml", "rb") as f:
-    conf = tomllib.load(f)
+# 处理模式：ass 字幕模式，video 视频模式（Gemini）
+MODES = ('ass', 'video')
+# 自动模式：有可用字幕时使用字幕模式，否则使用视频模式
+AUTO = 'auto'
+
+
+class _Section(BaseModel):
+    # 未声明的配置项不会生效，启动时给出警告（多半是拼写错误或旧版本的配置）
+    model_config = ConfigDict(extra='allow')
+
+
+class GeminiSettings(_Section):
+    api_key_list: list[str] = []
+    model: str = 'gemini-2.5-pro'
+    proxy: str = ''
+    # 0 表示不限制
+    rpm: NonNegativeInt = 5
+    tpm: NonNegativeInt = 250000
+    cooldown_seconds: NonNegativeFloat = 60
+    file_timeout: PositiveFloat = 600
+    file_keep_hours: NonNegativeFloat = 24
+
+
+class SponsorSettings(_Section):
+    api: str
+    private_id: str
+    user_agent: str
+    cache_ttl: NonNegativeFloat = 3600
+    negative_cache_ttl: NonNegativeFloat = 600
+    cache_size: PositiveInt = 4096
+    hash_prefix_length: int = Field(4, ge=4, le=64)
+
+
+class RunningSettings(_Section):
+    mode: Literal['ass', 'video', 'auto'] = 'ass'
+    min_second: NonNegativeInt = 60
+    max_second: PositiveInt = 1800
+    media_mode: Literal['muxed', 'audio', 'low'] = 'muxed'
+    feed_max_pages: PositiveInt = 10
+
+
+class AssSettings(_Section):
+    api_key: str = ''
+    base_url: str = ''
+    use_model: str = ''
+    stream: bool = True
+    thinking: bool = True
+    thinking_budget: PositiveInt = 4096
+    # 不填与 thinking 相同
+    first_pass_thinking: Optional[bool] = None
+    verbose: bool = False
+    max_duration: PositiveInt = 3600
+    window_tokens: PositiveInt = 6000
+    window_overlap_seconds: NonNegativeFloat = 30
+    window_concurrency: PositiveInt = 4
+    # 不填与 window_tokens 相同
+    compact_budget: Optional[PositiveInt] = None
+    timestamp_precision: int = Field(0, ge=0, le=3)
+    # 不填使用内置列表
+    filler_words: Optional[list[str]] = None
+
+
+class PrescreenSettings(_Section):
+    enabled: bool = False
+    # 不填使用内置列表
+    keywords: list[str] = []
+    extra_keywords: list[str] = []
+    context_seconds: NonNegativeFloat = 60
+    max_ratio: float = Field(0.6, ge=0, le=1)
+    # 0 表示不保存
+    sample_max_rows: NonNegativeInt = 2000
+
+
+class ClaimsSettings(_Section):
+    backend: Literal['memory', 'sqlite'] = 'memory'
+    path: str = 'shared/claims.db'
+    # 不填使用主机名加进程号
+    worker_id: str = ''
+    # 不填与 jobs.visibility_timeout 相同
+    lease_seconds: Optional[PositiveFloat] = None
+    keep_days: NonNegativeFloat = 30
+
+
+class PipelineSettings(_Section):
+    """各阶段的最大并发数，stage(name) 读取 {name}_concurrency"""
+    meta_concurrency: PositiveInt = 4
+    download_concurrency: PositiveInt = 4
+    analyze_concurrency: PositiveInt = 3
+    submit_concurrency: PositiveInt = 2
+    # 各处理模式同时处理的视频数（包括重试等待），视频模式需要下载、上传视频，默认较少
+    ass_concurrency: PositiveInt = 10
+    video_concurrency: PositiveInt = 3
+    # 同时处理的视频总数，多实例部署时只有拿到名额的视频才会被领取
+    active_concurrency: PositiveInt = 16
+
+
+class RouterSettings(_Section):
+    min_subtitle_coverage: float = Field(0.2, ge=0, le=1)
+
+
+class CacheSettings(_Section):
+    analysis_enabled: bool = True
+    analysis_max_rows: PositiveInt = 5000
+    analysis_max_age_days: PositiveFloat = 30
+
+
+class JobsSettings(_Section):
+    batch_size: PositiveInt = 50
+    visibility_timeout: PositiveFloat = 1800
+    retry_delay: NonNegativeFloat = 600
+    max_attempts: PositiveInt = 5
+    busy_retry_delay: PositiveFloat = 300
+    keep_days: PositiveFloat = 30
+
+
+class HttpOptions(_Section):
+    """单个上游服务的覆盖配置，不填的项使用 [http] 中的设置"""
+    max_connections: Optional[PositiveInt] = None
+    max_keepalive_connections: Optional[NonNegativeInt] = None
+    keepalive_expiry: Optional[NonNegativeFloat] = None
+    timeout: Optional[PositiveFloat] = None
+    connect_timeout: Optional[PositiveFloat] = None
+    http2: Optional[bool] = None
+
+
+class HttpSettings(_Section):
+    max_connections: PositiveInt = 20
+    max_keepalive_connections: NonNegativeInt = 10
+    keepalive_expiry: NonNegativeFloat = 60
+    timeout: PositiveFloat = 60
+    connect_timeout: PositiveFloat = 10
+    http2: bool = False
+    bilibili_api: HttpOptions = HttpOptions()
+    bilibili_cdn: HttpOptions = HttpOptions()
+    subtitle: HttpOptions = HttpOptions()
+    sponsor: HttpOptions = HttpOptions()
+    openai: HttpOptions = HttpOptions()
+
+
+Hour = Annotated[int, Field(ge=0, le=23)]
+
+
+class SchedulerSettings(_Section):
+    min_interval: PositiveFloat = 120
+    max_interval: PositiveFloat = 1800
+    backoff: float = Field(1.5, ge=1)
+    activity_window_hours: PositiveFloat = 6
+    # [开始小时, 结束小时)，为空表示关闭
+    quiet_hours: Optional[tuple[Hour, Hour]] = (2, 7)
+    quiet_interval: NonNegativeFloat = 1800
+    jitter: float = Field(0.1, ge=0, lt=1)
+
+    @field_validator('quiet_hours', mode='before')
+    @classmethod
+    def _empty_quiet_hours(cls, value):
+        return value or None
+
+
+class MetricsSettings(_Section):
+    enabled: bool = False
+    host: str = '127.0.0.1'
+    port: int = Field(9464, ge=1, le=65535)
+
+
+class RetrySettings(_Section):
+    max_delay: PositiveFloat = 300
+    # 0 表示不限制
+    budget_per_cycle: NonNegativeInt = 50
+    breaker_failures: PositiveInt = 5
+    breaker_reset_seconds: PositiveFloat = 60
+
+
+class CredentialSettings(_Section):
+    valid_ttl: PositiveFloat = 3600
+    check_interval: PositiveFloat = 1800
+
+
+class WorkspaceSettings(_Section):
+    # 不填使用系统临时目录下的 sponsor-helper-media
+    dir: str = ''
+    quota_mb: PositiveFloat = 2048
+    default_reserve_mb: PositiveFloat = 64
+    keep_downloads: bool = True
+
+
+class Settings(_Section):
+    gemini: GeminiSettings = GeminiSettings()
+    sponsor: SponsorSettings
+    running: RunningSettings = RunningSettings()
+    ass: AssSettings = AssSettings()
+    prescreen: PrescreenSettings = PrescreenSettings()
+    claims: ClaimsSettings = ClaimsSettings()
+    pipeline: PipelineSettings = PipelineSettings()
+    router: RouterSettings = RouterSettings()
+    cache: CacheSettings = CacheSettings()
+    jobs: JobsSettings = JobsSettings()
+    http: HttpSettings = HttpSettings()
+    scheduler: SchedulerSettings = SchedulerSettings()
+    metrics: MetricsSettings = MetricsSettings()
+    retry: RetrySettings = RetrySettings()
+    credential: CredentialSettings = CredentialSettings()
+    workspace: WorkspaceSettings = WorkspaceSettings()
+
+    @model_validator(mode='after')
+    def _check_mode(self):
+        """只校验当前模式需要的配置"""
+        if self.running.mode == 'ass' and not self.configured('ass'):
+            raise ValueError('字幕模式需要配置 ass.api_key、ass.base_url 和 ass.use_model')
+        if self.running.mode == 'video' and not self.configured('video'):
+            raise ValueError('视频模式需要配置 gemini.api_key_list')
+        if self.running.mode == AUTO and not any(self.configured(x) for x in MODES):
+            raise ValueError('自动模式至少需要配置 [ass] 或 gemini.api_key_list 其中之一')
+        return self
+
+    def configured(self, mode: str) -> bool:
+        """该模式需要的配置是否已填写"""
+        if mode == 'ass':
+            return bool(self.ass.api_key and self.ass.base_url and self.ass.use_model)
+        if mode == 'video':
+            return bool(self.gemini.api_key_list)
+        return False
+
+    def uses(self, mode: str) -> bool:
+        """是否会用到该模式，自动模式下已配置的模式都会用到"""
+        if self.running.mode == AUTO:
+            return self.configured(mode)
+        return self.running.mode == mode
+
+
+def _unknown_keys(model: BaseModel, prefix: str = ''):
+    for key in model.model_extra or {}:
+        yield f'{prefix}{key}'
+    for name in type(model).model_fields:
+        value = getattr(model, name)
+        if isinstance(value, BaseModel):
+            yield from _unknown_keys(value, f'{prefix}{name}.')
+
+
+def load_settings(path: str = 'project.toml') -> Settings:
+    if not os.path.exists(path):
+        raise Exception('找不到配置文件project.toml，请将文件project.example.toml复制一份，然后修改其中的配置！！')
+    with open(path, 'rb') as f:
+        data = tomllib.load(f)
+    try:
+        result = Settings.model_validate(data)
+    except ValidationError as e:
+        # 不输出配置原文，避免 key 出现在日志中
+        errors = '\n'.join(f'  {".".join(str(x) for x in err["loc"]) or "配置"}: {err["msg"]}' for err in e.errors())
+        raise Exception(f'配置文件 {path} 有误：\n{errors}') from None
+    for key in _unknown_keys(result):
+        logger.warning(f'未知的配置项 {key}，已忽略')
+    return result
+
+
+# 各配置项的默认值都在上面的模型中，各模块通过 settings.<section>.<name> 读取
+settings = load_settings()
+gemini_conf = settings.gemini
+sponsor_conf = settings.sponsor
+running_conf = settings.running
+ass_conf = settings.ass
+
+_gemini_scheduler: Optional[KeyScheduler] = None
 
-gemini_conf = conf['gemini']
-sponsor_conf = conf['sponsor']
-running_conf = conf['running']
-ass_conf = conf['ass']
 
 def gemini_client(api_key):
+    from google import genai
+    from google.genai import types
+
     options = types.HttpOptions(
         timeout=120000,
     )
-    if gemini_conf['proxy']:
-        options.client_args={'proxy': gemini_conf['proxy']}
+    if gemini_conf.proxy:
+        options.client_args={'proxy': gemini_conf.proxy}
 
     return genai.Client(api_key=api_key,http_options=options)
 
 
-all_gemini_client = [gemini_client(x) for x in gemini_conf['api_key_list']]
+def get_gemini_scheduler() -> KeyScheduler:
+    """第一次调用时创建所有 Gemini 客户端"""
+    global _gemini_scheduler
+    if _gemini_scheduler is None:
+        # 免费层 gemini-2.5-pro 每个 key 每分钟 5 次请求、25 万 token
+        _gemini_scheduler = KeyScheduler(
+            [ApiKey(f'key{i}', gemini_client(api_key), gemini_conf.rpm, gemini_conf.tpm,
+                    hashlib.sha256(api_key.encode()).hexdigest()[:16])
+             for i, api_key in enumerate(gemini_conf.api_key_list)],
+            cooldown=gemini_conf.cooldown_seconds,
+        )
+    return _gemini_scheduler
 
 
-def get_google_client() -> Client:
-    return random.choice(all_gemini_client)
\ No newline at end of file
+def gemini_started() -> bool:
+    return _gemini_scheduler is not None
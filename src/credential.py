@@ -1,24 +1,73 @@
+"""
+B 站登录凭证：启动时校验一次，之后由后台任务定期校验和刷新
+每轮处理调用 validate() 时直接使用缓存的校验结果，不发网络请求
+"""
 import asyncio
 import json
 import os.path
+import tempfile
+import time
 from typing import Optional
 
+import httpx
 from bilibili_api import Credential, login_v2
+from bilibili_api.exceptions import ResponseCodeException, NetworkException
 from bilibili_api.login_v2 import QrCodeLoginEvents
 from loguru import logger
 
+from src.config import settings
 from src.utils import get_now_str
 
+credential_conf = settings.credential
+
+CREDENTIAL_FILE = 'credential.json'
+
 credential: Optional[Credential] = None
+# 校验结果的有效期（time.monotonic），过期前 validate() 不再请求网络
+_valid_until = 0.0
+_lock: Optional[asyncio.Lock] = None
+_refresh_task: Optional[asyncio.Task] = None
+
 
 def get_credential() -> Credential:
     if credential is None:
         raise Exception('Credential not initialized.')
     return credential
 
+
+def _get_lock() -> asyncio.Lock:
+    global _lock
+    if _lock is None:
+        _lock = asyncio.Lock()
+    return _lock
+
+
+def _mark_valid():
+    global _valid_until
+    _valid_until = time.monotonic() + credential_conf.valid_ttl
+
+
+def invalidate():
+    """凭证被接口拒绝时调用，下一次 validate() 会重新校验"""
+    global _valid_until
+    _valid_until = 0.0
+
+
+def is_auth_error(e: Exception) -> bool:
+    """B 站接口因为凭证无效拒绝了请求：返回 code -101（账号未登录）或者 http 401"""
+    if isinstance(e, ResponseCodeException):
+        return e.code == -101
+    if isinstance(e, NetworkException):
+        return e.status == 401
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 401
+    return False
+
+
 async def init():
-    if os.path.exists('credential.json'):
-        with open('credential.json', 'r') as f:
+    global credential
+    if os.path.exists(CREDENTIAL_FILE):
+        with open(CREDENTIAL_FILE, 'r') as f:
             data = json.load(f)
 
             sessdata = data['sessdata']
@@ -30,8 +79,9 @@ async def init():
                           ac_time_value=ac_time_value)
 
             if await tmp.check_valid():
-                global credential
                 credential = tmp
+                _mark_valid()
+    start_background_refresh()
 
 async def is_valid():
     if credential is None:
@@ -40,17 +90,27 @@ async def is_valid():
         return await credential.check_valid()
 
 def save_credential():
+    """先写临时文件再替换，写到一半退出也不会损坏原来的凭证文件"""
     if credential is None:
         raise Exception('Credential not initialized.')
-    with open('credential.json', 'w') as f:
+    directory = os.path.dirname(os.path.abspath(CREDENTIAL_FILE))
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.credential-', suffix='.tmp', delete=False) as f:
         f.write(json.dumps({
             'sessdata': credential.sessdata,
             'bili_jct': credential.bili_jct,
             'ac_time_value': credential.ac_time_value,
             'update_time': get_now_str()
         }))
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.replace(f.name, CREDENTIAL_FILE)
+    except BaseException:
+        os.remove(f.name)
+        raise
 
-async def refresh_credential():
+async def refresh_credential() -> bool:
+    """刷新凭证并保存，返回是否成功"""
     if credential is None:
         raise Exception('Credential not initialized.')
     try:
@@ -58,8 +118,10 @@ async def refresh_credential():
         logger.info("Credential refreshed.")
 
         save_credential()
+        return True
     except Exception:
         logger.exception("Failed to refresh credential.")
+        return False
 
 
 async def qr_login():
@@ -86,16 +148,69 @@ async def qr_login():
             global credential
             credential = qr.get_credential()
             save_credential()
+            _mark_valid()
 
             return True
 
-async def validate() -> Optional[Credential]:
+
+async def _check_and_refresh():
+    """校验凭证，需要刷新时刷新，返回凭证是否有效"""
     if not await is_valid():
-        logger.info('credential无效，需要二维码登录获取新的凭证')
-        if not await qr_login():
-            return None
-    elif credential.ac_time_value and await credential.check_refresh():
+        invalidate()
+        return False
+    if credential.ac_time_value and await credential.check_refresh():
         logger.info('凭证已过期，刷新凭证')
-        await refresh_credential()
+        if not await refresh_credential():
+            # 凭证暂时还能用，但不缓存校验结果，下一次 validate() 重新校验和刷新
+            return True
+    _mark_valid()
+    return True
+
 
-    return credential
\ No newline at end of file
+async def _refresh_loop():
+    """在校验结果过期之前定期校验和刷新，处理视频时不需要等待"""
+    interval = credential_conf.check_interval
+    while True:
+        await asyncio.sleep(interval)
+        if credential is None:
+            continue
+        try:
+            async with _get_lock():
+                if not await _check_and_refresh():
+                    logger.warning('credential已失效，下一轮处理时重新登录')
+        except Exception as e:
+            # 网络问题时保留之前的校验结果，下次再试
+            logger.warning(f'后台校验凭证失败: {e}')
+
+
+def start_background_refresh():
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(_refresh_loop())
+
+
+async def close():
+    global _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        try:
+            await _refresh_task
+        except asyncio.CancelledError:
+            pass
+        _refresh_task = None
+
+
+async def validate() -> Optional[Credential]:
+    # 校验结果还在有效期内，直接使用
+    if credential is not None and time.monotonic() < _valid_until:
+        return credential
+
+    async with _get_lock():
+        if credential is not None and time.monotonic() < _valid_until:
+            return credential
+        if not await _check_and_refresh():
+            logger.info('credential无效，需要二维码登录获取新的凭证')
+            if not await qr_login():
+                return None
+
+    return credential
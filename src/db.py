@@ -1,7 +1,10 @@
-import datetime
+import asyncio
 import json
-import os.path
 import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 from loguru import logger
 
@@ -9,20 +12,256 @@ from src.utils import get_now_str
 
 db_file = 'data.db'
 
-def commit_exists(bvid: str):
-    with sqlite3.connect(db_file) as conn:
-        c = conn.execute('select * from commit_history where bvid = ?', (bvid,))
-        return c.fetchone() is not None
+# 长连接，只在 _executor 这一个线程里使用（init 阶段除外），不会阻塞事件循环
+_conn: Optional[sqlite3.Connection] = None
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
 
-def insert_commit(bvid: str, data: any, up_id: int, up_name: str):
+SQL_COMMIT_EXISTS = 'select 1 from commit_history where bvid = ? limit 1'
+SQL_UPSERT_COMMIT = '''insert into commit_history (bvid, json_data, up_id, up_name, commit_time) values (?, ?, ?, ?, ?)
+    on conflict(bvid) do update set json_data = excluded.json_data, up_id = excluded.up_id,
+    up_name = excluded.up_name, commit_time = excluded.commit_time'''
+
+
+def get_conn() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(db_file, check_same_thread=False)
+        _conn.execute('pragma journal_mode = WAL')
+        _conn.execute('pragma synchronous = NORMAL')
+        _conn.execute('pragma busy_timeout = 5000')
+    return _conn
+
+
+async def run_db(func, *args):
+    """把数据库操作放到专用线程中执行"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, func, *args)
+
+
+def _commit_exists(bvid: str):
+    c = get_conn().execute(SQL_COMMIT_EXISTS, (bvid,))
+    return c.fetchone() is not None
+
+async def commit_exists(bvid: str):
+    return await run_db(_commit_exists, bvid)
+
+def _insert_commit(bvid: str, data: any, up_id: int, up_name: str):
     commit_time = get_now_str()
-    with sqlite3.connect(db_file) as conn:
-        conn.execute('insert into commit_history (bvid, json_data,up_id, up_name,commit_time) values (?, ?, ?, ?, ?)', (bvid, json.dumps(data,ensure_ascii=False), up_id, up_name,commit_time))
+    conn = get_conn()
+    with conn:
+        conn.execute(SQL_UPSERT_COMMIT, (bvid, json.dumps(data, ensure_ascii=False), up_id, up_name, commit_time))
+
+async def insert_commit(bvid: str, data: any, up_id: int, up_name: str):
+    await run_db(_insert_commit, bvid, data, up_id, up_name)
+
+
+def _get_feed_mark():
+    """读取动态流的高水位（上次处理到的最新动态）"""
+    c = get_conn().execute("select value from feed_state where name = 'high_water_mark'")
+    row = c.fetchone()
+    return json.loads(row[0]) if row else None
+
+async def get_feed_mark():
+    return await run_db(_get_feed_mark)
+
+def _set_feed_mark(dynamic_id: str, pub_ts: int):
+    value = json.dumps({'id': dynamic_id, 'pub_ts': pub_ts, 'update_time': get_now_str()})
+    conn = get_conn()
+    with conn:
+        conn.execute("insert or replace into feed_state (name, value) values ('high_water_mark', ?)", (value,))
+
+async def set_feed_mark(dynamic_id: str, pub_ts: int):
+    await run_db(_set_feed_mark, dynamic_id, pub_ts)
+
+
+def _get_analysis(key: str, max_age: float):
+    conn = get_conn()
+    with conn:
+        # 过期的缓存在下次写入时才会删除，这里直接视为未命中
+        row = conn.execute('select result from analysis_cache where key = ? and created_at >= ?',
+                           (key, time.time() - max_age)).fetchone()
+        if row is None:
+            return None
+        conn.execute('update analysis_cache set last_used = ?, hits = hits + 1 where key = ?', (time.time(), key))
+    return json.loads(row[0])
+
+async def get_analysis(key: str, max_age: float):
+    return await run_db(_get_analysis, key, max_age)
+
+def _set_analysis(key: str, model: str, result: any, max_rows: int, max_age: float):
+    now = time.time()
+    conn = get_conn()
+    with conn:
+        conn.execute('''insert or replace into analysis_cache (key, model, result, created_at, last_used, hits)
+                        values (?, ?, ?, ?, ?, 0)''', (key, model, json.dumps(result, ensure_ascii=False), now, now))
+        # 淘汰过期的和最久未使用的缓存
+        conn.execute('delete from analysis_cache where created_at < ?', (now - max_age,))
+        conn.execute('''delete from analysis_cache where key in
+                        (select key from analysis_cache order by last_used desc limit -1 offset ?)''', (max_rows,))
+
+async def set_analysis(key: str, model: str, result: any, max_rows: int, max_age: float):
+    await run_db(_set_analysis, key, model, result, max_rows, max_age)
+
+
+JOB_COLUMNS = 'bvid, up_id, up_name, mode, state, data, attempts'
+# 这些状态的任务不会再被领取
+JOB_FINAL_STATES = ('done', 'skipped', 'failed')
+
+def _enqueue_job(bvid: str, up_id: int, up_name: str, mode: str):
+    now = time.time()
+    conn = get_conn()
+    with conn:
+        c = conn.execute('''insert or ignore into jobs (bvid, up_id, up_name, mode, state, data, attempts, lease_until,
+                            next_run, created_at, updated_at) values (?, ?, ?, ?, 'discovered', '{}', 0, 0, 0, ?, ?)''',
+                         (bvid, up_id, up_name, mode, now, now))
+        return c.rowcount > 0
+
+async def enqueue_job(bvid: str, up_id: int, up_name: str, mode: str):
+    """新增任务，已存在时忽略，返回是否新增"""
+    return await run_db(_enqueue_job, bvid, up_id, up_name, mode)
+
+def _claim_jobs(limit: int, visibility_timeout: float):
+    now = time.time()
+    conn = get_conn()
+    with conn:
+        rows = conn.execute(f'''update jobs set lease_until = ?, attempts = attempts + 1, updated_at = ?
+                                where bvid in (select bvid from jobs where state not in {JOB_FINAL_STATES}
+                                               and lease_until < ? and next_run <= ? order by created_at limit ?)
+                                returning {JOB_COLUMNS}''', (now + visibility_timeout, now, now, now, limit)).fetchall()
+    return [{**dict(zip(JOB_COLUMNS.split(', '), row)), 'data': json.loads(row[5])} for row in rows]
+
+async def claim_jobs(limit: int, visibility_timeout: float):
+    """领取可执行的任务，领取后在 visibility_timeout 秒内其他领取者看不到这些任务"""
+    return await run_db(_claim_jobs, limit, visibility_timeout)
+
+def _update_job(bvid: str, state: str, data: dict, lease_until: float, next_run: float = 0, error: str = None,
+                attempts: int = None):
+    conn = get_conn()
+    with conn:
+        conn.execute('''update jobs set state = ?, data = ?, lease_until = ?, next_run = ?, error = ?, updated_at = ?,
+                        attempts = coalesce(?, attempts) where bvid = ?''',
+                     (state, json.dumps(data, ensure_ascii=False), lease_until, next_run, error, time.time(), attempts,
+                      bvid))
+
+async def update_job(bvid: str, state: str, data: dict, lease_until: float, next_run: float = 0, error: str = None,
+                     attempts: int = None):
+    """attempts 不为空时同时修改尝试次数"""
+    await run_db(_update_job, bvid, state, data, lease_until, next_run, error, attempts)
+
+def _set_job_mode(bvid: str, mode: str):
+    conn = get_conn()
+    with conn:
+        conn.execute('update jobs set mode = ?, updated_at = ? where bvid = ?', (mode, time.time(), bvid))
+
+async def set_job_mode(bvid: str, mode: str):
+    await run_db(_set_job_mode, bvid, mode)
+
+def _prune_jobs(finished_before: float):
+    conn = get_conn()
+    with conn:
+        return conn.execute(f'delete from jobs where state in {JOB_FINAL_STATES} and updated_at < ?',
+                            (finished_before,)).rowcount
+
+async def prune_jobs(finished_before: float):
+    """删除 finished_before 之前已经结束的任务，返回删除的条数"""
+    return await run_db(_prune_jobs, finished_before)
+
+def _count_jobs():
+    rows = get_conn().execute('select state, count(*) from jobs group by state').fetchall()
+    return dict(rows)
+
+async def count_jobs():
+    return await run_db(_count_jobs)
+
+
+def _save_subtitle_sample(bvid: str, title: str, body: list, max_rows: int):
+    conn = get_conn()
+    data = zlib.compress(json.dumps(body, ensure_ascii=False).encode())
+    with conn:
+        conn.execute('insert or replace into subtitle_samples (bvid, title, body, created_at) values (?, ?, ?, ?)',
+                     (bvid, title, data, time.time()))
+        conn.execute('''delete from subtitle_samples where bvid in
+                        (select bvid from subtitle_samples order by created_at desc limit -1 offset ?)''', (max_rows,))
+
+async def save_subtitle_sample(bvid: str, title: str, body: list, max_rows: int):
+    """保存大模型分析过的完整字幕（压缩），只保留最新的 max_rows 条"""
+    await run_db(_save_subtitle_sample, bvid, title, body, max_rows)
+
+
+GEMINI_FILE_COLUMNS = ('key_id', 'name', 'uri', 'mime_type', 'state', 'expire_at')
+
+def _find_gemini_files(bvid: str, cid: int, media_mode: str, min_expire_at: float):
+    rows = get_conn().execute('''select key_id, name, uri, mime_type, state, expire_at from gemini_files
+                                 where bvid = ? and cid = ? and media_mode = ? and expire_at > ?''',
+                              (bvid, cid, media_mode, min_expire_at)).fetchall()
+    return [dict(zip(GEMINI_FILE_COLUMNS, row)) for row in rows]
+
+async def find_gemini_files(bvid: str, cid: int, media_mode: str, min_expire_at: float):
+    return await run_db(_find_gemini_files, bvid, cid, media_mode, min_expire_at)
+
+def _save_gemini_file(key_id: str, bvid: str, cid: int, media_mode: str, file: dict):
+    conn = get_conn()
+    with conn:
+        conn.execute('''insert or replace into gemini_files (key_id, bvid, cid, media_mode, name, uri, mime_type, state,
+                        expire_at, created_at) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                     (key_id, bvid, cid, media_mode, file['name'], file['uri'], file['mime_type'], file['state'],
+                      file['expire_at'], time.time()))
+
+async def save_gemini_file(key_id: str, bvid: str, cid: int, media_mode: str, file: dict):
+    await run_db(_save_gemini_file, key_id, bvid, cid, media_mode, file)
+
+def _set_gemini_file_state(key_id: str, name: str, state: str):
+    conn = get_conn()
+    with conn:
+        conn.execute('update gemini_files set state = ? where key_id = ? and name = ?', (state, key_id, name))
+
+async def set_gemini_file_state(key_id: str, name: str, state: str):
+    await run_db(_set_gemini_file_state, key_id, name, state)
+
+def _delete_gemini_file(key_id: str, name: str):
+    conn = get_conn()
+    with conn:
+        conn.execute('delete from gemini_files where key_id = ? and name = ?', (key_id, name))
+
+async def delete_gemini_file(key_id: str, name: str):
+    await run_db(_delete_gemini_file, key_id, name)
+
+def _stale_gemini_files(created_before: float, expire_before: float):
+    rows = get_conn().execute('select key_id, name from gemini_files where created_at < ? or expire_at < ?',
+                              (created_before, expire_before)).fetchall()
+    return [dict(zip(('key_id', 'name'), row)) for row in rows]
+
+async def stale_gemini_files(created_before: float, expire_before: float):
+    return await run_db(_stale_gemini_files, created_before, expire_before)
+
+
+def close():
+    global _conn
+    _executor.shutdown(wait=True)
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+
+def _migrate_bvid_index(conn: sqlite3.Connection):
+    """旧库的 bvid 没有索引，也可能有重复记录，保留每个 bvid 最新的一条后建立唯一索引"""
+    c = conn.execute("select * from sqlite_master where type = 'index' and name = 'idx_commit_history_bvid'")
+    if c.fetchone() is not None:
+        return
+    with conn:
+        deleted = conn.execute('''delete from commit_history where id not in
+                                  (select max(id) from commit_history group by bvid)''').rowcount
+        if deleted:
+            logger.warning(f'migrate sqlite, remove {deleted} duplicated commit_history rows')
+        logger.info('migrate sqlite, create unique index on commit_history.bvid')
+        conn.execute('create unique index idx_commit_history_bvid on commit_history (bvid)')
 
 
 def init():
-    if not os.path.exists(db_file):
-        with sqlite3.connect(db_file) as conn:
+    conn = get_conn()
+    c = conn.execute("select * from sqlite_master where type = 'table' and name = 'commit_history'")
+    if c.fetchone() is None:
+        with conn:
             logger.info('init sqlite, create table commit_history')
             conn.execute("""create table commit_history
                          (
@@ -33,14 +272,71 @@ def init():
                              up_name   text,
                              commit_time text
                          )""")
-    with sqlite3.connect(db_file) as conn:
+    _migrate_bvid_index(conn)
+    with conn:
         c = conn.execute("select * from sqlite_master where type = 'view' and name = 'up_summary'")
         if c.fetchone() is None:
             logger.info('init sqlite, create view up_summary')
-            conn.execute("""CREATE VIEW up_summary as 
-            SELECT up_id, up_name, 
-            SUM(CASE WHEN json_extract(json_data, '$.haveAd') IS TRUE THEN 1 ELSE 0 END) AS ad_count, 
-            SUM(CASE WHEN json_extract(json_data, '$.haveAd') IS NOT TRUE THEN 1 ELSE 0 END) AS not_ad_count, 
-                   count(*) as total_count 
+            conn.execute("""CREATE VIEW up_summary as
+            SELECT up_id, up_name,
+            SUM(CASE WHEN json_extract(json_data, '$.haveAd') IS TRUE THEN 1 ELSE 0 END) AS ad_count,
+            SUM(CASE WHEN json_extract(json_data, '$.haveAd') IS NOT TRUE THEN 1 ELSE 0 END) AS not_ad_count,
+                   count(*) as total_count
             FROM commit_history GROUP BY up_id, up_name order by total_count desc
-            """)
\ No newline at end of file
+            """)
+        conn.execute("""create table if not exists feed_state
+                     (
+                         name  text primary key,
+                         value text
+                     )""")
+        conn.execute("""create table if not exists analysis_cache
+                     (
+                         key        text primary key,
+                         model      text,
+                         result     text,
+                         created_at real,
+                         last_used  real,
+                         hits       integer
+                     )""")
+        conn.execute('create index if not exists idx_analysis_cache_last_used on analysis_cache (last_used)')
+        conn.execute("""create table if not exists jobs
+                     (
+                         bvid        text primary key,
+                         up_id       integer,
+                         up_name     text,
+                         mode        text,
+                         state       text,
+                         data        text,
+                         attempts    integer,
+                         lease_until real,
+                         next_run    real,
+                         error       text,
+                         created_at  real,
+                         updated_at  real
+                     )""")
+        conn.execute('create index if not exists idx_jobs_state on jobs (state, next_run)')
+        conn.execute("""create table if not exists subtitle_samples
+                     (
+                         bvid       text primary key,
+                         title      text,
+                         body       blob,
+                         created_at real
+                     )""")
+        conn.execute("""create table if not exists gemini_files
+                     (
+                         key_id     text,
+                         bvid       text,
+                         cid        integer,
+                         media_mode text,
+                         name       text,
+                         uri        text,
+                         mime_type  text,
+                         state      text,
+                         expire_at  real,
+                         created_at real,
+                         primary key (key_id, bvid, cid, media_mode)
+                     )""")
+        # 本地库只有本进程使用，启动时之前领取的任务都已经没人在处理了
+        released = conn.execute('update jobs set lease_until = 0 where lease_until > 0').rowcount
+        if released:
+            logger.info(f'init sqlite, release {released} unfinished jobs')
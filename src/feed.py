@@ -0,0 +1,83 @@
+"""增量拉取关注动态，基于持久化的高水位只发现一次新视频"""
+from bilibili_api import Credential, dynamic
+from bilibili_api.dynamic import DynamicType
+from loguru import logger
+
+from src.config import running_conf
+from src.credential import invalidate, is_auth_error
+from src.db import get_feed_mark, set_feed_mark
+from src.utils import is_near
+
+
+def _dynamic_id(item) -> int:
+    return int(item.get('id_str') or 0)
+
+
+def _is_seen(item, mark) -> bool:
+    """动态是否已经在高水位之前（含）"""
+    dynamic_id = _dynamic_id(item)
+    if dynamic_id and mark.get('id'):
+        return dynamic_id <= int(mark['id'])
+    return item['modules']['module_author']['pub_ts'] <= mark['pub_ts']
+
+
+class FeedBatch:
+    """一次拉取的结果，处理完成后调用 commit 推进高水位"""
+
+    def __init__(self, items: list, newest):
+        self.items = items
+        self.newest = newest
+
+    async def commit(self):
+        if self.newest is None:
+            return
+        pub_ts = self.newest['modules']['module_author']['pub_ts']
+        await set_feed_mark(self.newest['id_str'], pub_ts)
+        logger.debug(f'动态高水位推进到 {self.newest["id_str"]}')
+
+
+async def fetch_new_items(credential: Credential) -> FeedBatch:
+    """
+    按 offset 游标向后翻页，直到越过上次记录的高水位为止
+    首次运行（没有高水位）时只看第一页，并用 is_near 过滤，避免把历史视频全部处理一遍
+    """
+    mark = await get_feed_mark()
+    max_pages = running_conf.feed_max_pages
+
+    items = []
+    newest = None
+    offset = None
+    pages = 0
+    while True:
+        try:
+            result = await dynamic.get_dynamic_page_info(credential, DynamicType.VIDEO, offset=offset)
+        except Exception as e:
+            if is_auth_error(e):
+                # 凭证在校验结果的有效期内失效了，下一轮重新校验，需要时重新登录
+                logger.warning(f'拉取动态时凭证被拒绝: {e}')
+                invalidate()
+            raise
+        pages += 1
+        page_items = result.get('items') or []
+
+        crossed = False
+        for item in page_items:
+            if mark is not None and _is_seen(item, mark):
+                crossed = True
+                break
+            if newest is None or _dynamic_id(item) > _dynamic_id(newest):
+                newest = item
+            if mark is not None or is_near(item):
+                items.append(item)
+
+        if mark is None or crossed:
+            break
+        if not result.get('has_more') or not result.get('offset'):
+            break
+        if pages >= max_pages:
+            logger.warning(f'已翻页 {pages} 页仍未到达上次的高水位，停止翻页')
+            break
+        offset = result['offset']
+
+    logger.info(f'拉取动态 {pages} 页，发现 {len(items)} 条新动态')
+    return FeedBatch(items, newest)
@@ -0,0 +1,83 @@
+"""已上传到 Gemini 的文件登记：按 (key, bvid, cid, 媒体模式) 复用，过期后清理"""
+import time
+
+from loguru import logger
+
+from src.config import gemini_conf
+from src.db import find_gemini_files, save_gemini_file, set_gemini_file_state, delete_gemini_file, stale_gemini_files
+
+# Gemini 上传的文件保存 48 小时，留出余量，快过期的文件不再复用
+DEFAULT_TTL = 48 * 3600
+EXPIRE_MARGIN = 3600
+
+
+def _expire_at(file) -> float:
+    if file.expiration_time is not None:
+        return file.expiration_time.timestamp()
+    return time.time() + DEFAULT_TTL
+
+
+async def find(bvid: str, cid: int, media_mode: str) -> list[dict]:
+    """查找还没有过期的已上传文件，可能分布在多个 key 上"""
+    return await find_gemini_files(bvid, cid, media_mode, time.time() + EXPIRE_MARGIN)
+
+
+async def save(key, bvid: str, cid: int, media_mode: str, file):
+    await save_gemini_file(key.key_id, bvid, cid, media_mode, {
+        'name': file.name,
+        'uri': file.uri,
+        'mime_type': file.mime_type,
+        'state': file.state.name,
+        'expire_at': _expire_at(file),
+    })
+
+
+async def update_state(key, file):
+    """文件处理完成后更新登记的状态"""
+    await set_gemini_file_state(key.key_id, file.name, file.state.name)
+
+
+async def forget(key, name: str):
+    await delete_gemini_file(key.key_id, name)
+
+
+async def reuse(key, handles: list[dict]):
+    """如果这个 key 上已经有上传好的文件，返回最新的文件对象，文件已失效时删除登记"""
+    for handle in handles:
+        if handle['key_id'] != key.key_id:
+            continue
+        try:
+            file = await key.client.aio.files.get(name=handle['name'])
+        except Exception as e:
+            logger.info(f'已上传的文件 {handle["name"]} 不可用，重新上传: {e}')
+            await forget(key, handle['name'])
+            return None
+        if file.state.name == 'FAILED':
+            await forget(key, handle['name'])
+            return None
+        logger.info(f'复用已上传的文件 {file.name}')
+        return file
+    return None
+
+
+async def evict(keys):
+    """
+    清理过期或保留时间超过 file_keep_hours 的文件登记，并删除远端文件释放存储空间
+    keys: 所有的 ApiKey，用于找到文件所属的 client
+    """
+    now = time.time()
+    keep_seconds = gemini_conf.file_keep_hours * 3600
+    stale = await stale_gemini_files(now - keep_seconds, now + EXPIRE_MARGIN)
+    if not stale:
+        return
+    by_id = {x.key_id: x for x in keys}
+    for handle in stale:
+        key = by_id.get(handle['key_id'])
+        if key is not None:
+            try:
+                await key.client.aio.files.delete(name=handle['name'])
+            except Exception as e:
+                # 文件可能已经被 Gemini 自动删除
+                logger.debug(f'删除远端文件 {handle["name"]} 失败: {e}')
+        await delete_gemini_file(handle['key_id'], handle['name'])
+    logger.info(f'清理 {len(stale)} 个过期的 Gemini 文件')
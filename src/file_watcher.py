@@ -0,0 +1,127 @@
+"""统一轮询 Gemini 上传文件的处理状态"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+from loguru import logger
+
+from src import metrics
+
+
+@dataclass
+class _Pending:
+    name: str
+    future: asyncio.Future
+    next_poll: float
+    interval: float
+    polls: int = 0
+
+
+@dataclass
+class _Group:
+    client: object
+    files: dict[str, _Pending] = field(default_factory=dict)
+
+
+class FileWatcher:
+    """
+    所有等待处理的文件由一个后台任务统一轮询，按 key（client）分组
+    同一个 key 下有多个文件时用一次 files.list 查询全部状态，否则用 files.get
+    首次轮询时间按文件大小估算，之后按倍数退避
+    """
+
+    def __init__(self, min_interval: float = 2, max_interval: float = 30, seconds_per_mb: float = 0.5,
+                 backoff: float = 1.5, timeout: float = 600):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.seconds_per_mb = seconds_per_mb
+        self.backoff = backoff
+        self.timeout = timeout
+        self._groups: dict[int, _Group] = {}
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    def _first_interval(self, file) -> float:
+        size_mb = (file.size_bytes or 0) / 1024 / 1024
+        return min(self.max_interval, max(self.min_interval, size_mb * self.seconds_per_mb))
+
+    async def wait_active(self, client, file, timeout: float = None):
+        """等待文件处理完成，返回最新的文件对象（ACTIVE 或 FAILED），超时抛出 TimeoutError"""
+        if file.state.name != 'PROCESSING':
+            return file
+
+        group = self._groups.setdefault(id(client), _Group(client))
+        future = asyncio.get_running_loop().create_future()
+        interval = self._first_interval(file)
+        group.files[file.name] = _Pending(file.name, future, time.monotonic() + interval, interval)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'等待文件 {file.name} 处理超时')
+        finally:
+            group.files.pop(file.name, None)
+            if not group.files and self._groups.get(id(client)) is group:
+                self._groups.pop(id(client), None)
+
+    async def _run(self):
+        while self._groups:
+            now = time.monotonic()
+            polls = []
+            for group in list(self._groups.values()):
+                due = [x for x in group.files.values() if x.next_poll <= now]
+                if due:
+                    polls.append(self._poll_group(group, due))
+            if polls:
+                await asyncio.gather(*polls)
+            for key, group in list(self._groups.items()):
+                if not group.files:
+                    self._groups.pop(key, None)
+
+            pending = [x.next_poll for g in self._groups.values() for x in g.files.values()]
+            if not pending:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, min(pending) - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_group(self, group: _Group, due: list[_Pending]):
+        try:
+            if len(group.files) > 1:
+                found = await self._list_files(group.client)
+                missing = [x for x in due if x.name not in found]
+                for x in missing:
+                    found[x.name] = await self._get_file(group.client, x.name)
+            else:
+                found = {x.name: await self._get_file(group.client, x.name) for x in due}
+        except Exception as e:
+            logger.warning(f'查询文件状态失败: {e}')
+            found = {}
+
+        now = time.monotonic()
+        for x in due:
+            x.polls += 1
+            file = found.get(x.name)
+            if file is not None and file.state.name != 'PROCESSING':
+                group.files.pop(x.name, None)
+                if not x.future.done():
+                    x.future.set_result(file)
+                continue
+            x.interval = min(self.max_interval, x.interval * self.backoff)
+            x.next_poll = now + x.interval
+        logger.debug(f'文件状态轮询：{len(due)} 个文件，仍在处理 {sum(1 for x in due if not x.future.done())} 个')
+
+    async def _get_file(self, client, name):
+        metrics.inc('gemini_file_polls_total', method='get')
+        return await client.aio.files.get(name=name)
+
+    async def _list_files(self, client) -> dict:
+        """只取第一页，找不到的文件由调用方单独查询"""
+        metrics.inc('gemini_file_polls_total', method='list')
+        pager = await client.aio.files.list(config={'page_size': 100})
+        return {x.name: x for x in pager.page}
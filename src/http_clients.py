@@ -0,0 +1,78 @@
+"""按上游服务共享的 http 客户端，复用连接池，避免每次请求都重新握手"""
+import importlib.util
+
+import httpx
+from loguru import logger
+
+from src.config import settings, ass_conf
+
+http_conf = settings.http
+
+# 上游服务，以及各自不同于 [http] 的默认设置（可以在配置 [http.<名称>] 中覆盖）
+UPSTREAMS = {
+    'bilibili_api': {},
+    # 视频文件较大，读取超时放宽
+    'bilibili_cdn': {'timeout': 300},
+    'subtitle': {},
+    'sponsor': {},
+    'openai': {'timeout': 600},
+}
+
+_clients: dict[str, httpx.AsyncClient] = {}
+_openai_client = None
+
+
+def _option(name: str, key: str):
+    value = getattr(getattr(http_conf, name), key)
+    if value is not None:
+        return value
+    return UPSTREAMS[name].get(key, getattr(http_conf, key))
+
+
+def _http2_enabled(name: str) -> bool:
+    if not _option(name, 'http2'):
+        return False
+    if importlib.util.find_spec('h2') is None:
+        logger.warning(f'{name} 配置了 http2，但没有安装 h2（pip install h2），使用 HTTP/1.1')
+        return False
+    return True
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """获取某个上游服务共享的客户端，首次使用时创建"""
+    if name not in UPSTREAMS:
+        raise Exception(f'未知的上游服务 {name}')
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        limits = httpx.Limits(
+            max_connections=_option(name, 'max_connections'),
+            max_keepalive_connections=_option(name, 'max_keepalive_connections'),
+            keepalive_expiry=_option(name, 'keepalive_expiry'),
+        )
+        client = httpx.AsyncClient(
+            limits=limits,
+            timeout=httpx.Timeout(_option(name, 'timeout'), connect=_option(name, 'connect_timeout')),
+            http2=_http2_enabled(name),
+        )
+        _clients[name] = client
+    return client
+
+
+def get_openai_client():
+    """字幕模式使用的 OpenAI 兼容客户端，底层使用共享的 openai 连接池"""
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+
+        _openai_client = AsyncOpenAI(api_key=ass_conf.api_key, base_url=ass_conf.base_url,
+                                     http_client=get_client('openai'))
+    return _openai_client
+
+
+async def close_all():
+    """关闭所有客户端，释放连接"""
+    global _openai_client
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
+    _openai_client = None
@@ -0,0 +1,160 @@
+"""持久化的视频处理任务：每个阶段完成后保存检查点，重启后从上一个完成的阶段继续"""
+import time
+from dataclasses import dataclass, field
+
+from loguru import logger
+
+from src import metrics
+from src.claims import claim_store, ClaimLostError, BUSY, DONE as CLAIM_DONE
+from src.config import settings
+from src.db import enqueue_job, claim_jobs, update_job, set_job_mode, prune_jobs
+from src.pipeline import stage
+from src.retry import is_retryable, CircuitOpenError
+
+jobs_conf = settings.jobs
+
+# 任务状态，按处理顺序排列
+DISCOVERED = 'discovered'
+MEDIA_FETCHED = 'media_fetched'
+ANALYZED = 'analyzed'
+SUBMITTED = 'submitted'
+DONE = 'done'
+# 不需要处理（已处理过、时长不符合、没有字幕等）
+SKIPPED = 'skipped'
+# 超过最大尝试次数
+FAILED = 'failed'
+STATES = (DISCOVERED, MEDIA_FETCHED, ANALYZED, SUBMITTED, DONE, SKIPPED, FAILED)
+# 只在处理过程中需要的数据，任务结束后不再保存（字幕、空降助手的原始返回）
+TRANSIENT_FIELDS = ('body', 'res')
+
+
+def visibility_timeout() -> float:
+    return jobs_conf.visibility_timeout
+
+
+@dataclass
+class Job:
+    bvid: str
+    up_id: int
+    up_name: str
+    mode: str
+    state: str = DISCOVERED
+    data: dict = field(default_factory=dict)
+    attempts: int = 0
+
+    async def checkpoint(self, state: str, **data):
+        """保存阶段产出并进入下一个状态，同时续期领取租约；租约已被其他实例接手时抛出 ClaimLostError"""
+        if not await claim_store.renew(self.bvid):
+            raise ClaimLostError(f'视频 {self.bvid} 已由其他实例处理')
+        self.data.update(data)
+        self.state = state
+        await update_job(self.bvid, state, self.data, time.time() + visibility_timeout())
+        logger.debug(f'任务 {self.bvid} 进入状态 {state}')
+
+    async def switch_mode(self, mode: str):
+        """自动模式选定处理模式后保存，之后重试或重启时直接使用该模式"""
+        self.mode = mode
+        await set_job_mode(self.bvid, mode)
+
+    def _drop_transient(self):
+        for key in TRANSIENT_FIELDS:
+            self.data.pop(key, None)
+
+    async def finish(self, state: str = DONE, reason: str = None):
+        self.state = state
+        if reason:
+            self.data['reason'] = reason
+        self._drop_transient()
+        await update_job(self.bvid, state, self.data, 0)
+
+    async def fail(self, e: Exception):
+        """
+        处理失败，稍后重试；超过最大尝试次数或者是不可重试的错误时不再处理
+        上游熔断导致的失败不计入尝试次数，等熔断结束后再处理
+        """
+        max_attempts = jobs_conf.max_attempts
+        error = repr(e)
+        if isinstance(e, CircuitOpenError):
+            await self.postpone(time.time() + e.retry_in, error)
+            return
+        if self.attempts >= max_attempts or not is_retryable(e):
+            if is_retryable(e):
+                logger.error(f'任务 {self.bvid} 已失败 {self.attempts} 次，不再重试')
+            else:
+                logger.error(f'任务 {self.bvid} 出现不可重试的错误，不再重试: {error}')
+            self.state = FAILED
+            self._drop_transient()
+            await update_job(self.bvid, FAILED, self.data, 0, error=error)
+            return
+        delay = jobs_conf.retry_delay * self.attempts
+        await update_job(self.bvid, self.state, self.data, 0, time.time() + delay, error)
+
+    async def postpone(self, until: float, error: str = None):
+        """推迟到 until 再处理，不计入尝试次数"""
+        self.attempts = max(0, self.attempts - 1)
+        await update_job(self.bvid, self.state, self.data, 0, until, error, self.attempts)
+
+
+async def add_job(bvid: str, up_id: int, up_name: str, mode: str = 'ass') -> bool:
+    return await enqueue_job(bvid, up_id, up_name, mode)
+
+
+async def take_jobs(limit: int = None) -> list[Job]:
+    """领取待处理（包括之前中断、失败待重试）的任务"""
+    rows = await claim_jobs(limit or jobs_conf.batch_size, visibility_timeout())
+    return [Job(**row) for row in rows]
+
+
+async def prune_finished():
+    """删除结束超过 [jobs] keep_days 天的任务"""
+    removed = await prune_jobs(time.time() - jobs_conf.keep_days * 86400)
+    if removed:
+        logger.info(f'清理 {removed} 个已结束的任务')
+
+
+async def run_job(job: Job, handler):
+    """
+    执行任务，失败时记录错误并安排重试，然后把异常继续抛出
+    拿到处理名额（[pipeline] active_concurrency）后才领取视频，只领取马上要处理的，剩下的留给其他实例
+    其他实例正在处理时推迟到对方租约到期后，其他实例已经处理完成时跳过
+    """
+    async with stage('active'):
+        await _run_claimed(job, handler)
+
+
+async def _run_claimed(job: Job, handler):
+    claim = await claim_store.claim(job.bvid)
+    metrics.inc('claims_total', status=claim.status)
+    if claim.status == CLAIM_DONE:
+        logger.info(f'视频 {job.bvid} 已由实例 {claim.worker} 处理完成，跳过')
+        await job.finish(SKIPPED, '其他实例已处理')
+        metrics.inc('videos_total', mode=job.mode, outcome=SKIPPED)
+        return
+    if claim.status == BUSY:
+        until = min(claim.lease_until, time.time() + jobs_conf.busy_retry_delay)
+        logger.info(f'视频 {job.bvid} 正在由实例 {claim.worker} 处理，稍后再看')
+        await job.postpone(until)
+        metrics.inc('videos_total', mode=job.mode, outcome='busy')
+        return
+
+    try:
+        await handler(job)
+        if job.state not in (DONE, SKIPPED, FAILED):
+            await job.finish()
+        metrics.inc('videos_total', mode=job.mode, outcome=job.state)
+    except ClaimLostError as e:
+        logger.warning(str(e))
+        await job.finish(SKIPPED, '其他实例已处理')
+        metrics.inc('videos_total', mode=job.mode, outcome=SKIPPED)
+        return
+    except Exception as e:
+        await claim_store.release(job.bvid)
+        await job.fail(e)
+        metrics.inc('videos_total', mode=job.mode, outcome=FAILED if job.state == FAILED else 'retry')
+        raise
+
+    # 完成的视频其他实例不再处理；跳过的视频（时长不符合、没有字幕等）留给其他实例按自己的配置判断
+    if job.state == DONE:
+        await claim_store.complete(job.bvid)
+    else:
+        await claim_store.release(job.bvid)
@@ -0,0 +1,147 @@
+"""Gemini API key 调度：按负载选择 key，遵守每分钟请求/token 预算，限流后冷却"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from loguru import logger
+
+WINDOW = 60
+
+
+def is_quota_error(e: Exception) -> bool:
+    """429 / RESOURCE_EXHAUSTED 视为限流或额度用尽"""
+    if getattr(e, 'code', None) == 429 or getattr(e, 'status_code', None) == 429:
+        return True
+    status = getattr(e, 'status', None)
+    return status == 'RESOURCE_EXHAUSTED' or 'RESOURCE_EXHAUSTED' in str(e)
+
+
+class ApiKey:
+    def __init__(self, name: str, client, rpm: int, tpm: int, key_id: str = None):
+        self.name = name
+        # 不保存 key 原文的稳定标识，用于持久化和 key 关联的数据（如已上传的文件）
+        self.key_id = key_id or name
+        self.client = client
+        self.rpm = rpm
+        self.tpm = tpm
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.total_requests = 0
+        self.total_tokens = 0
+        self.total_errors = 0
+        self.quota_errors = 0
+        self._requests: deque[float] = deque()
+        self._tokens: deque[tuple[float, int]] = deque()
+
+    def _trim(self, now: float):
+        while self._requests and self._requests[0] <= now - WINDOW:
+            self._requests.popleft()
+        while self._tokens and self._tokens[0][0] <= now - WINDOW:
+            self._tokens.popleft()
+
+    def window_tokens(self) -> int:
+        return sum(x[1] for x in self._tokens)
+
+    def wait_time(self, now: float) -> float:
+        """距离这个 key 可以再发一次请求还要等多久，0 表示现在就可以"""
+        self._trim(now)
+        wait = max(0.0, self.cooldown_until - now)
+        if self.rpm and len(self._requests) >= self.rpm:
+            wait = max(wait, self._requests[0] + WINDOW - now)
+        if self.tpm and self._tokens and self.window_tokens() >= self.tpm:
+            wait = max(wait, self._tokens[0][0] + WINDOW - now)
+        return wait
+
+    def load(self, now: float):
+        self._trim(now)
+        return self.in_flight, len(self._requests), self.window_tokens()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        self._trim(now)
+        return {
+            'name': self.name,
+            'in_flight': self.in_flight,
+            'requests_last_minute': len(self._requests),
+            'tokens_last_minute': self.window_tokens(),
+            'cooldown_seconds': round(max(0.0, self.cooldown_until - now), 1),
+            'total_requests': self.total_requests,
+            'total_tokens': self.total_tokens,
+            'total_errors': self.total_errors,
+            'quota_errors': self.quota_errors,
+        }
+
+
+class KeyScheduler:
+    """
+    acquire() 选出当前负载最低且有预算的 key，整个视频的上传、等待、生成都使用同一个 key
+    每次调用模型前用 wait_budget() 等待该 key 的预算，调用后用 record()/report_error() 记账
+    """
+
+    def __init__(self, keys: list[ApiKey], cooldown: float = 60):
+        self.keys = keys
+        self.cooldown = cooldown
+        self._changed = asyncio.Event()
+
+    def _pick(self, now: float, prefer=()):
+        ready = [x for x in self.keys if x.wait_time(now) == 0]
+        if not ready:
+            return None
+        preferred = [x for x in ready if x.key_id in prefer]
+        return min(preferred or ready, key=lambda x: x.load(now))
+
+    @asynccontextmanager
+    async def acquire(self, prefer=()):
+        """
+        prefer: 优先使用的 key_id（例如已经上传过该视频的 key），这些 key 暂时不可用时选择其他 key
+        """
+        if not self.keys:
+            raise Exception('没有配置 Gemini api_key')
+        while True:
+            now = time.monotonic()
+            key = self._pick(now, prefer)
+            if key is not None:
+                break
+            wait = min(x.wait_time(now) for x in self.keys)
+            logger.info(f'所有 Gemini key 都没有剩余额度，等待 {round(wait, 1)} 秒')
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+        key.in_flight += 1
+        try:
+            yield key
+        finally:
+            key.in_flight -= 1
+            self._changed.set()
+
+    async def wait_budget(self, key: ApiKey):
+        while True:
+            wait = key.wait_time(time.monotonic())
+            if wait <= 0:
+                break
+            logger.info(f'Gemini {key.name} 预算不足，等待 {round(wait, 1)} 秒')
+            await asyncio.sleep(wait)
+        # 先占用请求名额，避免同一个 key 的并发请求同时通过检查
+        now = time.monotonic()
+        key._requests.append(now)
+        key.total_requests += 1
+
+    def record(self, key: ApiKey, tokens: int = 0):
+        if tokens:
+            key._tokens.append((time.monotonic(), tokens))
+            key.total_tokens += tokens
+
+    def report_error(self, key: ApiKey, e: Exception):
+        key.total_errors += 1
+        if is_quota_error(e):
+            key.quota_errors += 1
+            key.cooldown_until = time.monotonic() + self.cooldown
+            logger.warning(f'Gemini {key.name} 被限流，冷却 {self.cooldown} 秒')
+        self._changed.set()
+
+    def stats(self) -> list[dict]:
+        return [x.stats() for x in self.keys]
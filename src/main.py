@@ -1,33 +1,72 @@
-from bilibili_api import dynamic
-from bilibili_api.dynamic import DynamicType
 from loguru import logger
 
-from src.ass_mode import process_video_ass
+from src import file_registry, metrics
+from src.config import settings, get_gemini_scheduler, gemini_started
 from src.credential import validate
-from src.process_ad import process_video
-from src.utils import is_near
+from src.db import count_jobs
+from src.feed import fetch_new_items
+from src.jobs import add_job, take_jobs, run_job, prune_finished, DISCOVERED, STATES
+from src.pipeline import run_videos
+from src.retry import retry_budget
+from src.router import process_job
+from src.sponsor import segment_lookup
+from src.workspace import workspace
+
+
+async def collect_metrics():
+    """抓取指标时更新任务队列深度和 Gemini key 的负载"""
+    counts = await count_jobs()
+    for state in STATES:
+        metrics.set_gauge('jobs', counts.get(state, 0), state=state)
+    metrics.set_gauge('workspace_bytes', workspace.used())
+    if not gemini_started():
+        return
+    for item in get_gemini_scheduler().stats():
+        metrics.set_gauge('gemini_key_in_flight', item['in_flight'], key=item['name'])
+        metrics.set_gauge('gemini_key_requests_last_minute', item['requests_last_minute'], key=item['name'])
+
+metrics.register_collector(collect_metrics)
 
 
 async def run_per_loop():
+    """执行一轮：拉取动态、登记任务、处理视频，返回本轮新发现视频的发布时间，供轮询调度使用"""
     credential = await validate()
     if not credential:
-        return
-    # 处理视频广告逻辑  拉取自己的动态
-    result = await dynamic.get_dynamic_page_info(credential, DynamicType.VIDEO)
+        return []
+    retry_budget.reset()
+    await prune_finished()
+    # 清理过期的 Gemini 上传文件
+    if settings.uses('video') or gemini_started():
+        await file_registry.evict(get_gemini_scheduler().keys)
 
-    items = result['items']
+    # 处理视频广告逻辑  增量拉取自己的动态
+    with metrics.timer('stage_seconds', stage='feed'):
+        batch = await fetch_new_items(credential)
 
-    video_list = [x for x in items if x['type'] == 'DYNAMIC_TYPE_AV' and is_near(x)]
-
-    if len(video_list) == 0:
-        logger.info('没有新视频')
+    video_list = [x for x in batch.items if x['type'] == 'DYNAMIC_TYPE_AV']
 
+    added = 0
     for video in video_list:
         video_id = video['modules']['module_dynamic']['major']['archive']['bvid']
         user_id = video['modules']['module_author']['mid']
         up_name = video['modules']['module_author']['name']
+        if await add_job(video_id, user_id, up_name, settings.running.mode):
+            added += 1
+
+    # 新视频已经写入任务表，可以直接推进高水位
+    await batch.commit()
+    logger.info(f'新增 {added} 个视频任务')
+    pub_times = [x['modules']['module_author']['pub_ts'] for x in video_list]
+
+    # 领取新任务，以及之前中断或等待重试的任务
+    jobs = await take_jobs()
+    if len(jobs) == 0:
+        logger.info('没有新视频')
+        return pub_times
+
+    # 先批量查询空降助手上的已有片段，后续的单个查询直接命中缓存
+    await segment_lookup.prefetch(x.bvid for x in jobs if x.state == DISCOVERED)
 
-        try:
-            await process_video_ass(video_id, user_id, up_name)
-        except Exception as e:
-            logger.exception(f'处理视频{video_id}出错： {e}')
+    # 各视频并发处理，单个慢视频不会阻塞其他视频
+    await run_videos(jobs, lambda job: run_job(job, process_job))
+    return pub_times
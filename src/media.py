@@ -0,0 +1,112 @@
+"""视频模式的媒体流选择：只下载识别广告所需的最小码率"""
+import asyncio
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+from loguru import logger
+
+from src.config import running_conf
+from src.utils import remove_file
+
+# muxed: 旧的 durl 音视频合一 mp4
+# audio: 只下载最低码率音轨
+# low: 最低码率视频轨 + 最低码率音轨，用 ffmpeg 合成一个文件（没有 ffmpeg 时退化为 audio）
+MEDIA_MODES = ('muxed', 'audio', 'low')
+
+# playurl 参数：fnval=16 返回 DASH 分离流，qn=16 为 360P
+DASH_PARAMS = {'fnval': 16, 'qn': 16, 'fourk': 0}
+MUXED_PARAMS = {'qn': 16}
+
+# avc 编码兼容性最好，同等条件下优先
+CODEC_AVC = 7
+
+MIME_TYPES = {
+    '.mp4': 'video/mp4',
+    '.m4a': 'audio/mp4',
+}
+
+
+_media_mode: Optional[str] = None
+
+
+def get_media_mode() -> str:
+    """实际使用的媒体模式，第一次调用时确定（取值在读取配置时已经校验过），之后不再检查 ffmpeg"""
+    global _media_mode
+    if _media_mode is None:
+        _media_mode = running_conf.media_mode
+        if _media_mode == 'low' and not has_ffmpeg():
+            logger.warning('未找到 ffmpeg，media_mode=low 退化为 audio')
+            _media_mode = 'audio'
+    return _media_mode
+
+
+def has_ffmpeg() -> bool:
+    return shutil.which('ffmpeg') is not None
+
+
+def get_mime_type(file: str) -> str:
+    return MIME_TYPES.get(os.path.splitext(file)[1], 'video/mp4')
+
+
+def _stream_url(stream) -> str:
+    return stream.get('baseUrl') or stream.get('base_url')
+
+
+def select_video(dash) -> dict:
+    """选择码率最低的视频轨，优先 avc 编码"""
+    videos = dash.get('video') or []
+    if not videos:
+        raise Exception('播放地址中没有视频轨')
+    avc = [x for x in videos if x.get('codecid') == CODEC_AVC]
+    return min(avc or videos, key=lambda x: x.get('bandwidth', 0))
+
+
+def select_audio(dash) -> dict:
+    """选择码率最低的音轨"""
+    audios = dash.get('audio') or []
+    if not audios:
+        raise Exception('播放地址中没有音轨')
+    return min(audios, key=lambda x: x.get('bandwidth', 0))
+
+
+def select_urls(play_data, mode: str) -> dict:
+    """
+    根据模式从 playurl 返回中选出要下载的流
+    返回 {'video': url, 'audio': url}，只包含需要下载的部分
+    """
+    if mode == 'muxed':
+        return {'video': play_data['durl'][0]['url']}
+
+    dash = play_data.get('dash')
+    if not dash:
+        raise Exception('播放地址中没有 DASH 流')
+    audio = select_audio(dash)
+    urls = {'audio': _stream_url(audio)}
+    if mode == 'low':
+        video = select_video(dash)
+        urls['video'] = _stream_url(video)
+        logger.info(f'选择视频轨 {video.get("id")} {video.get("bandwidth")}bps，音轨 {audio.get("id")} {audio.get("bandwidth")}bps')
+    else:
+        logger.info(f'选择音轨 {audio.get("id")} {audio.get("bandwidth")}bps')
+    return urls
+
+
+async def mux(video_file: str, audio_file: str, output: str = None) -> str:
+    """不重新编码，直接把视频轨和音轨封装成一个 mp4（output 为空时写入临时文件），成功后删除输入文件"""
+    if output is None:
+        fd, output = tempfile.mkstemp(suffix='.mp4')
+        os.close(fd)
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-y', '-loglevel', 'error', '-i', video_file, '-i', audio_file,
+        '-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', '-movflags', '+faststart', output,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        remove_file(output)
+        raise Exception(f'ffmpeg 合并音视频失败 {stderr.decode(errors="ignore")}')
+    remove_file(video_file)
+    remove_file(audio_file)
+    return output
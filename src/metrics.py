@@ -0,0 +1,198 @@
+"""
+运行指标：各阶段耗时、视频处理结果、重试、缓存命中、下载字节数、token 用量和任务队列深度
+通过本地 http 接口以 Prometheus 文本格式输出，配置 metrics.enabled=false（默认）时所有记录调用直接返回
+"""
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager, nullcontext
+
+from loguru import logger
+
+from src.config import settings
+
+metrics_conf = settings.metrics
+enabled = metrics_conf.enabled
+
+PREFIX = 'sponsor_helper_'
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# 指标名 -> (类型, 说明)
+METRICS = {
+    'stage_seconds': ('histogram', '各处理阶段耗时（秒）'),
+    'stage_wait_seconds': ('histogram', '等待阶段并发名额的时间（秒）'),
+    'llm_first_token_seconds': ('histogram', '字幕模式大模型首 token 耗时（秒）'),
+    'llm_request_seconds': ('histogram', '字幕模式大模型调用总耗时（秒）'),
+    'gemini_file_wait_seconds': ('histogram', '等待 Gemini 处理上传文件的时间（秒）'),
+    'videos_total': ('counter', '处理完成的视频数，按结果分类'),
+    'route_decisions_total': ('counter', '自动模式选择的处理模式，按原因分类'),
+    'prescreen_total': ('counter', '字幕关键词预筛结果：clean 不调用大模型，narrowed 只分析候选片段，full 分析全部字幕'),
+    'retries_total': ('counter', '@retry 触发的重试次数'),
+    'claims_total': ('counter', '领取视频的结果：claimed 由本实例处理，busy 其他实例正在处理，done 其他实例已处理完成'),
+    'gemini_file_polls_total': ('counter', '查询 Gemini 上传文件状态的接口调用次数，按 files.get / files.list 分类'),
+    'cache_requests_total': ('counter', '缓存查询次数，按命中与否分类'),
+    'download_bytes_total': ('counter', '下载的字节数'),
+    'tokens_total': ('counter', '模型调用消耗的 token 数'),
+    'jobs': ('gauge', '任务队列中各状态的任务数'),
+    'workspace_bytes': ('gauge', '下载工作目录占用的字节数'),
+    'gemini_key_in_flight': ('gauge', '各 Gemini key 正在处理的视频数'),
+    'gemini_key_requests_last_minute': ('gauge', '各 Gemini key 最近一分钟的请求数'),
+}
+
+
+class _Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+_counters: dict[tuple, float] = {}
+_gauges: dict[tuple, float] = {}
+_histograms: dict[tuple, _Histogram] = {}
+_collectors = []
+_NULL = nullcontext()
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    if not enabled:
+        return
+    _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = _Histogram()
+    histogram.observe(value)
+
+
+@contextmanager
+def _timer(name: str, labels: dict):
+    begin = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - begin, **labels)
+
+
+def timer(name: str, **labels):
+    """记录 with 块的耗时，未开启时返回空的上下文"""
+    if not enabled:
+        return _NULL
+    return _timer(name, labels)
+
+
+def register_collector(func):
+    """注册采集函数（协程），每次抓取指标前调用，用于更新队列深度等 gauge"""
+    _collectors.append(func)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+async def render() -> str:
+    """输出 Prometheus 文本格式"""
+    for func in _collectors:
+        try:
+            await func()
+        except Exception as e:
+            logger.warning(f'采集指标失败: {e}')
+
+    series: dict[str, list[str]] = {}
+    for (name, labels), value in list(_counters.items()) + list(_gauges.items()):
+        series.setdefault(name, []).append(f'{PREFIX}{name}{_format_labels(labels)} {_format_value(value)}')
+    for (name, labels), histogram in _histograms.items():
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram.count}')
+        lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {round(histogram.sum, 6)}')
+        lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}')
+
+    out = []
+    for name in sorted(series):
+        kind, help_text = METRICS.get(name, ('untyped', name))
+        out.append(f'# HELP {PREFIX}{name} {help_text}')
+        out.append(f'# TYPE {PREFIX}{name} {kind}')
+        out.extend(series[name])
+    return '\n'.join(out) + '\n'
+
+
+def _response(status: str, body: str, content_type: str = 'text/plain; charset=utf-8') -> bytes:
+    data = body.encode()
+    head = f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n'
+    return head.encode() + data
+
+
+async def start_server(routes: dict = None):
+    """
+    启动本地 http 接口：GET /metrics 输出指标
+    routes: 额外的 POST 接口，路径 -> 无参函数，例如 {'/trigger': poll_scheduler.trigger}
+    """
+    if not enabled:
+        return None
+    routes = routes or {}
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode(errors='ignore').split()
+            # 读完请求头，不需要请求体
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            method, path = (request_line + ['', ''])[:2]
+            path = path.split('?')[0]
+            if method == 'GET' and path == '/metrics':
+                writer.write(_response('200 OK', await render(), 'text/plain; version=0.0.4; charset=utf-8'))
+            elif method == 'POST' and path in routes:
+                routes[path]()
+                writer.write(_response('200 OK', 'ok\n'))
+            else:
+                writer.write(_response('404 Not Found', 'not found\n'))
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f'指标接口请求失败: {e}')
+        finally:
+            writer.close()
+
+    host = metrics_conf.host
+    port = metrics_conf.port
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f'指标接口已启动 http://{host}:{port}/metrics')
+    return server
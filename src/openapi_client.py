@@ -1,49 +1,168 @@
+import time
+from dataclasses import dataclass
+from typing import Optional
+
 from loguru import logger
-from openai import AsyncOpenAI
 
-from src.config import conf
+from src.config import ass_conf
+from src.http_clients import get_openai_client
+from src.metrics import observe, inc
+from src.retry import circuit
+from src.subtitle import estimate_tokens
+
+@dataclass
+class RequestMetrics:
+    """单次调用的耗时和 token 用量"""
+    first_token_seconds: Optional[float] = None
+    total_seconds: float = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    reasoning_chars: int = 0
+    stopped_early: bool = False
+
+
+class JsonObjectDetector:
+    """增量检测输出中第一个完整的顶层 JSON 对象是否已经结束（忽略字符串内的括号）"""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
 
-ass_conf = conf['ass']
-client = AsyncOpenAI(api_key=ass_conf['api_key'], base_url=ass_conf['base_url'])
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if ch == '"' and self.started:
+                self.in_string = True
+            elif ch == '{':
+                self.started = True
+                self.depth += 1
+            elif ch == '}' and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
 
-async def create_request(prompt: str, history=None):
+
+async def create_request(prompt: str, history=None, *, stream: bool = None, thinking: bool = None,
+                         stop_on_json: bool = False, metrics: RequestMetrics = None):
     """
-    支持流式打印内容并返回完整回复
+    调用模型并返回完整回复
     history: 用于存储对话上下文，便于追问
+    stream: 是否流式调用，默认读取配置 ass.stream
+    thinking: 是否开启思考，默认读取配置 ass.thinking
+    stop_on_json: 流式调用时，收到第一个完整的 JSON 对象后立即结束
+    metrics: 传入时会写入本次调用的耗时和 token 用量
     """
+    async with circuit('openai'):
+        return await _request(prompt, history, stream, thinking, stop_on_json, metrics)
+
+
+async def _request(prompt: str, history, stream: bool, thinking: bool, stop_on_json: bool, metrics: RequestMetrics):
     if history is None:
         history = [{"role": "user", "content": prompt}]
+    if stream is None:
+        stream = ass_conf.stream
+    if thinking is None:
+        thinking = ass_conf.thinking
+    verbose = ass_conf.verbose
+    metrics = metrics if metrics is not None else RequestMetrics()
 
-    response = await client.chat.completions.create(
-        model=ass_conf['use_model'],
+    extra_body = {"enable_thinking": thinking}
+    if thinking:
+        extra_body["thinking_budget"] = ass_conf.thinking_budget
+
+    client = get_openai_client()
+    begin = time.monotonic()
+    kwargs = dict(
+        model=ass_conf.use_model,
         messages=history,
-        stream=True,  # 开启流式传输
         max_tokens=4096,
-        extra_body={
-           "thinking_budget": 4096,
-           "enable_thinking": True,
-        },
+        extra_body=extra_body,
         temperature=0.6,
         top_p=0.95,
     )
 
-    full_content = ""
-    print("--- 模型思考中 ---")
+    if not stream:
+        response = await client.chat.completions.create(stream=False, **kwargs)
+        content = response.choices[0].message.content or ''
+        metrics.total_seconds = metrics.first_token_seconds = time.monotonic() - begin
+        if response.usage:
+            metrics.prompt_tokens = response.usage.prompt_tokens
+            metrics.completion_tokens = response.usage.completion_tokens
+        _log_metrics(metrics)
+        return content
+
+    response = await client.chat.completions.create(
+        stream=True,  # 开启流式传输
+        stream_options={"include_usage": True},
+        **kwargs,
+    )
+
+    # 用列表收集片段，最后一次性拼接
+    parts = []
+    detector = JsonObjectDetector() if stop_on_json else None
+    if verbose:
+        print("--- 模型思考中 ---")
 
     async for chunk in response:
+        if chunk.usage:
+            metrics.prompt_tokens = chunk.usage.prompt_tokens
+            metrics.completion_tokens = chunk.usage.completion_tokens
+        if not chunk.choices:
+            continue
         delta = chunk.choices[0].delta
 
+        if metrics.first_token_seconds is None:
+            metrics.first_token_seconds = time.monotonic() - begin
+
         # 1. 处理思考过程 (Reasoning Content)
-        if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
-            print(delta.reasoning_content, end="", flush=True)
+        reasoning = getattr(delta, 'reasoning_content', None)
+        if reasoning:
+            metrics.reasoning_chars += len(reasoning)
+            if verbose:
+                print(reasoning, end="", flush=True)
 
         # 2. 处理正式内容 (Content)
-        if hasattr(delta, 'content') and delta.content:
-            # 如果是刚开始输出正文，换个行
-            if not full_content:
-                print("\n\n--- 最终回答 ---")
-            print(delta.content, end="", flush=True)
-            full_content += delta.content
-
-    print("\n" + "-"*20)
-    return full_content
\ No newline at end of file
+        if delta.content:
+            if verbose:
+                # 如果是刚开始输出正文，换个行
+                if not parts:
+                    print("\n\n--- 最终回答 ---")
+                print(delta.content, end="", flush=True)
+            parts.append(delta.content)
+            if detector is not None and detector.feed(delta.content):
+                metrics.stopped_early = True
+                await response.close()
+                break
+
+    if verbose:
+        print("\n" + "-"*20)
+    content = "".join(parts)
+    metrics.total_seconds = time.monotonic() - begin
+    if not metrics.completion_tokens:
+        # 提前结束时拿不到服务端统计的用量，按字符估算
+        metrics.prompt_tokens = sum(estimate_tokens(x['content']) for x in history)
+        metrics.completion_tokens = estimate_tokens(content)
+    _log_metrics(metrics)
+    return content
+
+
+def _log_metrics(metrics: RequestMetrics):
+    first = round(metrics.first_token_seconds, 2) if metrics.first_token_seconds is not None else '-'
+    logger.info(f'模型调用：首 token {first} 秒，总耗时 {round(metrics.total_seconds, 2)} 秒，'
+                f'token {metrics.prompt_tokens}/{metrics.completion_tokens}'
+                f'{"，收到完整 JSON 后提前结束" if metrics.stopped_early else ""}')
+    if metrics.first_token_seconds is not None:
+        observe('llm_first_token_seconds', metrics.first_token_seconds)
+    observe('llm_request_seconds', metrics.total_seconds)
+    inc('tokens_total', metrics.prompt_tokens, provider='openai', kind='prompt')
+    inc('tokens_total', metrics.completion_tokens, provider='openai', kind='completion')
@@ -0,0 +1,77 @@
+"""分阶段并发处理流水线"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from loguru import logger
+
+from src import metrics
+from src.config import settings
+
+# 各阶段的并发数见 PipelineSettings：元数据获取、字幕/视频下载、AI分析、提交片段，以及各处理模式和总的视频数
+pipeline_conf = settings.pipeline
+
+_semaphores: dict[str, asyncio.Semaphore] = {}
+_video_locks: dict[str, asyncio.Lock] = {}
+
+
+def _get_semaphore(name: str) -> asyncio.Semaphore:
+    sem = _semaphores.get(name)
+    if sem is None:
+        sem = asyncio.Semaphore(getattr(pipeline_conf, f'{name}_concurrency'))
+        _semaphores[name] = sem
+    return sem
+
+
+@asynccontextmanager
+async def stage(name: str):
+    """
+    进入某个处理阶段，受该阶段的并发上限限制
+    出现异常时会立即释放名额，重试等待期间不会占用阶段并发
+    """
+    wait_begin = time.monotonic()
+    async with _get_semaphore(name):
+        metrics.observe('stage_wait_seconds', time.monotonic() - wait_begin, stage=name)
+        with metrics.timer('stage_seconds', stage=name):
+            yield
+
+
+@asynccontextmanager
+async def video_lock(video_id: str):
+    """同一个视频同时只允许一个协程处理，保证单个视频内各阶段按顺序执行"""
+    lock = _video_locks.setdefault(video_id, asyncio.Lock())
+    try:
+        async with lock:
+            yield
+    finally:
+        if not lock.locked() and _video_locks.get(video_id) is lock:
+            _video_locks.pop(video_id, None)
+
+
+async def run_videos(jobs, handler):
+    """
+    并发处理一批视频任务，返回本轮统计
+    jobs: 任务列表，需要有 bvid 属性
+    handler: 单个任务的处理协程函数
+    """
+    begin = time.monotonic()
+    stats = {'total': len(jobs), 'success': 0, 'failed': 0}
+
+    async def run_one(job):
+        async with video_lock(job.bvid):
+            try:
+                await handler(job)
+                stats['success'] += 1
+            except Exception as e:
+                stats['failed'] += 1
+                logger.exception(f'处理视频{job.bvid}出错： {e}')
+
+    await asyncio.gather(*(run_one(x) for x in jobs))
+
+    elapsed = time.monotonic() - begin
+    stats['elapsed'] = round(elapsed, 2)
+    if jobs:
+        per_min = round(len(jobs) / elapsed * 60, 2) if elapsed > 0 else len(jobs)
+        logger.info(f'本轮处理 {stats["total"]} 个视频，成功 {stats["success"]}，失败 {stats["failed"]}，'
+                    f'耗时 {stats["elapsed"]} 秒，吞吐 {per_min} 个/分钟')
+    return stats
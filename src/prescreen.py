@@ -0,0 +1,134 @@
+"""
+字幕关键词预筛：用 Aho-Corasick 多模式匹配在字幕中查找广告线索词（恰饭、赞助、优惠码、品牌名等）
+- 没有任何线索词的视频直接记为没有广告，不调用大模型
+- 有线索词时只把命中的字幕行前后一段时间内的字幕发给大模型
+只针对赞助类广告，三连提醒、片头片尾等其他类型的片段可能因此识别不到，默认关闭，
+开启前可以用 python -m bench.prescreen_eval 在已有的数据上评估准确率和召回率
+"""
+from collections import deque
+from dataclasses import dataclass, field
+
+from src.config import settings
+
+prescreen_conf = settings.prescreen
+
+DEFAULT_KEYWORDS = [
+    # 赞助、合作
+    '恰饭', '赞助', '金主', '广告', '推广', '合作', '本期视频由',
+    # 引导购买
+    '优惠码', '优惠券', '折扣', '领券', '券后', '下单', '购买', '入手', '到手价', '满减', '限时', '福利',
+    '链接', '评论区置顶', '置顶评论', '简介区', '简介里', '蓝链', '小黄车',
+    # 平台、常见品牌
+    '淘宝', '天猫', '京东', '拼多多', '旗舰店', '美团', '饿了么',
+    # 游戏推广
+    '公测', '预约', '兑换码', '礼包码',
+]
+
+
+class KeywordMatcher:
+    """Aho-Corasick 自动机，一次扫描找出文本中出现的所有关键词，英文不区分大小写"""
+
+    def __init__(self, keywords):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[str]] = [[]]
+        for word in keywords:
+            word = word.strip().lower()
+            if word:
+                self._insert(word)
+        self._build()
+
+    def _insert(self, word: str):
+        node = 0
+        for char in word:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = nxt
+        if word not in self._output[node]:
+            self._output[node].append(word)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def find(self, text: str) -> list[str]:
+        """返回命中的关键词，按出现顺序，可能重复"""
+        hits = []
+        node = 0
+        for char in text.lower():
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            if self._output[node]:
+                hits.extend(self._output[node])
+        return hits
+
+
+@dataclass
+class ScreenResult:
+    # 命中的关键词及次数
+    hits: dict[str, int] = field(default_factory=dict)
+    # 候选时间段（已合并），为空表示没有广告线索
+    regions: list[tuple[float, float]] = field(default_factory=list)
+
+    @property
+    def clean(self) -> bool:
+        return not self.regions
+
+
+class Prescreen:
+    def __init__(self, keywords, context_seconds: float = 60, max_ratio: float = 0.6):
+        self.matcher = KeywordMatcher(keywords)
+        self.context_seconds = context_seconds
+        self.max_ratio = max_ratio
+
+    def screen(self, body: list) -> ScreenResult:
+        """查找含有线索词的字幕行，每行前后扩展 context_seconds 秒作为候选时间段"""
+        result = ScreenResult()
+        regions = []
+        for item in body:
+            words = self.matcher.find(item['content'])
+            if not words:
+                continue
+            for word in words:
+                result.hits[word] = result.hits.get(word, 0) + 1
+            regions.append((max(0.0, item['from'] - self.context_seconds), item['to'] + self.context_seconds))
+
+        for begin, end in sorted(regions):
+            if result.regions and begin <= result.regions[-1][1]:
+                result.regions[-1] = (result.regions[-1][0], max(result.regions[-1][1], end))
+            else:
+                result.regions.append((begin, end))
+        return result
+
+    def select(self, body: list, regions: list[tuple[float, float]]) -> list:
+        """
+        返回落在候选时间段内的字幕行
+        候选时间段占了大部分字幕时返回全部字幕，只发一部分节省不了多少
+        """
+        selected = [x for x in body if any(x['to'] >= begin and x['from'] <= end for begin, end in regions)]
+        if len(selected) > len(body) * self.max_ratio:
+            return body
+        return selected
+
+
+def _keywords() -> list[str]:
+    return (prescreen_conf.keywords or DEFAULT_KEYWORDS) + prescreen_conf.extra_keywords
+
+
+prescreen = Prescreen(_keywords(), prescreen_conf.context_seconds, prescreen_conf.max_ratio)
+enabled = prescreen_conf.enabled
+sample_max_rows = prescreen_conf.sample_max_rows
@@ -1,125 +1,188 @@
 import asyncio
 import os
-import tempfile
 
-import httpx
 from bilibili_api import video, HEADERS
-from google.genai import types
 from loguru import logger
 from pydantic import BaseModel
 
-from src.config import sponsor_conf, get_google_client, running_conf, gemini_conf
+from src import file_registry, metrics
+from src.analysis_cache import cached
+from src.config import sponsor_conf, get_gemini_scheduler, running_conf, gemini_conf
 from src.db import commit_exists, insert_commit
-from src.retry import retry
+from src.file_watcher import FileWatcher
+from src.http_clients import get_client
+from src.jobs import Job, DISCOVERED, MEDIA_FETCHED, ANALYZED, SUBMITTED, SKIPPED
+from src.media import get_media_mode, select_urls, mux, get_mime_type, DASH_PARAMS, MUXED_PARAMS
+from src.pipeline import stage
+from src.retry import retry, circuit, HttpError
+from src.sponsor import segment_lookup
 from src.utils import SensitiveString
+from src.workspace import workspace, MediaFile
 
-http_client = httpx.AsyncClient()
+file_watcher = FileWatcher(timeout=gemini_conf.file_timeout)
 
 
-async def check_exist(video_id : str):
-    found = commit_exists(video_id)
+async def check_exist(video_id : str, fresh: bool = False):
+    """
+    本地已处理过，或者空降助手上已经有片段
+    fresh=True 时不使用"没有片段"的缓存，用于提交前的确认
+    """
+    found = await commit_exists(video_id)
     if found:
         return True
 
-    res = await http_client.get(f'{sponsor_conf['api']}/api/skipSegments?videoID={video_id}&category=sponsor', timeout=60)
-    if res.status_code == 404:
-        return False
-    if res.is_success:
-        resp = res.json()
-        return len(resp) > 0
-    return False
+    return await segment_lookup.exists(video_id, fresh=fresh)
+
+# 修改提示词或返回结构时需要升级版本号，使旧的缓存失效
+PROMPT_VERSION = 'gemini-v1'
 
 class AdModel(BaseModel):
     haveAd: bool
     beginTime: int
     endTime: int
 
-@retry(delay=10)
-async def process_video(video_id: str, up_id: int, up_name: str):
-    logger.info(f'video id: {video_id}')
-    if await check_exist(video_id):
-        logger.info(f'it has been processed, skip')
-        return
-
-    v = video.Video(bvid=video_id)
-    video_info =  await  v.get_info()
-
-    duration = video_info['pages'][0]['duration']
-    if duration < running_conf['min_second'] or duration > running_conf['max_second']:
-        logger.info(f'video duration {duration} is too long or too short, skip')
-        return
-
-    file = await download_file(video_id, video_info)
+def _build_payload(job: Job):
+    ad_result = job.data['ad_result']
+    return {
+        'videoID': job.bvid,
+        'userID': SensitiveString(sponsor_conf.private_id),
+        'userAgent': sponsor_conf.user_agent,
+        'videoDuration': job.data['duration'],
+        'segments': [
+            {
+                'segment': [ad_result['beginTime'], ad_result['endTime']],
+                'category': 'sponsor',
+                'actionType': 'skip'
+            }
+        ]
+    }
 
-    google_client = get_google_client()
 
-    logger.info('begin upload')
-    myfile = await google_client.aio.files.upload(file=file)
-    logger.info(f'upload file done')
+@retry(delay=10)
+async def process_video(job: Job):
+    """按任务状态逐个阶段处理，每个阶段完成后保存检查点"""
+    video_id = job.bvid
+    logger.info(f'video id: {video_id}, state: {job.state}')
+
+    if job.state == DISCOVERED:
+        if await check_exist(video_id):
+            logger.info(f'it has been processed, skip')
+            await job.finish(SKIPPED, 'processed')
+            return
+
+        v = video.Video(bvid=video_id)
+        async with stage('meta'), circuit('bilibili'):
+            video_info =  await  v.get_info()
+
+        duration = video_info['pages'][0]['duration']
+        if duration < running_conf.min_second or duration > running_conf.max_second:
+            logger.info(f'video duration {duration} is too long or too short, skip')
+            await job.finish(SKIPPED, 'duration')
+            return
+
+        await job.checkpoint(MEDIA_FETCHED, title=video_info['title'], cid=video_info['pages'][0]['cid'],
+                             duration=duration)
+
+    if job.state == MEDIA_FETCHED:
+        # 重试或重复处理时直接使用缓存的分析结果，不再下载、上传视频
+        media_id = f'{video_id}:{job.data["cid"]}:{get_media_mode()}'
+        ad_result = await cached(gemini_conf.model, PROMPT_VERSION, media_id,
+                                 lambda: analyze_video(video_id, job.data['cid'], job.data['duration']))
+        await job.checkpoint(ANALYZED, ad_result=AdModel.model_validate(ad_result).model_dump())
+
+    if job.state == ANALYZED:
+        ad_result = job.data['ad_result']
+        if not ad_result['haveAd']:
+            logger.info('no ad found')
+            await insert_commit(video_id, ad_result, job.up_id, job.up_name)
+            await job.finish()
+            return
+
+        payload = _build_payload(job)
+        async with stage('submit'):
+            if await check_exist(video_id, fresh=True):
+                logger.info(f'it has been processed, skip')
+                await job.finish(SKIPPED, 'processed')
+                return
+
+            logger.info(f'commit payload: {payload}')
+            # 提交片段
+            with metrics.timer('stage_seconds', stage='sponsor_post'):
+                async with circuit('sponsor'):
+                    res = await get_client('sponsor').post(f'{sponsor_conf.api}/api/skipSegments', json=payload)
+                    if not res.is_success:
+                        raise HttpError(res, '提交片段失败')
+
+        segment_lookup.mark(video_id)
+
+        logger.info(f'提交片段成功 {res.text}')
+        await job.checkpoint(SUBMITTED, res=res.text)
+
+    if job.state == SUBMITTED:
+        k = dict(job.data['ad_result'])
+        k.update(_build_payload(job))
+        k['userID'] = '******'
+        k['res'] = job.data['res']
+
+        await insert_commit(video_id, k, job.up_id, job.up_name)
+        await job.finish()
+
+async def analyze_video(video_id: str, cid: int, duration: int) -> dict:
+    """下载、上传视频并调用 Gemini 分析，返回 AdModel 的字典形式"""
+    media_mode = get_media_mode()
+    handles = await file_registry.find(video_id, cid, media_mode)
+
+    # 同一个视频的上传和分析必须使用同一个 key，优先选择已经上传过这个视频的 key
+    gemini_scheduler = get_gemini_scheduler()
+    async with gemini_scheduler.acquire(prefer=[x['key_id'] for x in handles]) as key:
+        google_client = key.client
+
+        myfile = await file_registry.reuse(key, handles)
+        if myfile is None:
+            async with stage('download'):
+                media = await download_file(video_id, cid)
+                uploaded = False
+                try:
+                    logger.info('begin upload')
+                    with metrics.timer('stage_seconds', stage='gemini_upload'):
+                        async with circuit('gemini'):
+                            myfile = await google_client.aio.files.upload(file=media.path,
+                                                                          config={'mime_type': get_mime_type(media.path)})
+                    uploaded = True
+                    logger.info(f'upload file done')
+                finally:
+                    # 上传完成后本地文件就没用了，立即删除；上传失败时保留，重试时不用重新下载
+                    workspace.release(media, done=uploaded)
+            await file_registry.save(key, video_id, cid, media_mode, myfile)
 
-    while myfile.state.name == "PROCESSING":
         logger.info('PROCESSING')
-        await asyncio.sleep(10)
-        myfile = await google_client.aio.files.get(name=myfile.name)
+        with metrics.timer('gemini_file_wait_seconds'):
+            myfile = await file_watcher.wait_active(google_client, myfile)
 
-    if myfile.state.name == "FAILED":
-        logger.error(f'处理文件失败 {myfile}')
-        raise ValueError(myfile.state.name)
+        if myfile.state.name == "FAILED":
+            logger.error(f'处理文件失败 {myfile}')
+            await file_registry.forget(key, myfile.name)
+            raise ValueError(myfile.state.name)
+        await file_registry.update_state(key, myfile)
 
-    logger.info('begin generate content')
+        logger.info('begin generate content')
 
-    response = await google_gen_response(google_client, myfile)
+        response = await google_gen_response(key, myfile)
 
     logger.info(response.text)
 
     ad_result: AdModel = response.parsed
 
-    if not ad_result.haveAd:
-        logger.info('no ad found')
-        insert_commit(video_id, ad_result.model_dump(), up_id, up_name)
-        return
-
-    if await check_exist(video_id):
-        logger.info(f'it has been processed, skip')
-        return
-
-    duration = video_info['pages'][0]['duration']
-
-    if (ad_result.endTime - ad_result.beginTime) > 0.8 *  duration:
+    # 明显不合理的结果不写入缓存，重试时重新分析
+    if ad_result.haveAd and (ad_result.endTime - ad_result.beginTime) > 0.8 *  duration:
         raise Exception('Total length over 80% of the video')
 
-    payload =  {
-        'videoID': video_id,
-        'userID': SensitiveString(sponsor_conf['private_id']),
-        'userAgent': sponsor_conf['user_agent'],
-        'videoDuration': video_info['pages'][0]['duration'],
-        'segments': [
-            {
-                'segment': [ad_result.beginTime, ad_result.endTime],
-                'category': 'sponsor',
-                'actionType': 'skip'
-            }
-        ]
-    }
-    logger.info(f'commit payload: {payload}')
-    # 提交片段
-    res = await http_client.post(f'{sponsor_conf['api']}/api/skipSegments', json=payload)
-
-    if not res.is_success:
-        raise Exception(f'提交片段失败 {res.text}')
-
-    logger.info(f'提交片段成功 {res.text}')
-
-    k = ad_result.model_dump()
-    k.update(payload)
-    k['userID'] = '******'
-    k['res'] = res.text
-
-    insert_commit(video_id, k, up_id, up_name)
+    return ad_result.model_dump()
 
 # AI生成失败，直接等待30秒重试
+# 每次尝试单独进入 analyze 阶段，重试等待和 key 的预算等待期间不占用分析并发
 @retry(delay=30, max_retries=2)
-async def google_gen_response(google_client, myfile):
+async def google_gen_response(key, myfile):
     prompt = """
 1.请帮我判断这个视频，判断是否中间是否有与视频内容无关的广告内容，如果是返回
 haveAd: true
@@ -130,32 +193,76 @@ haveAd: false
 beginTime: 0
 endTime: 0
 """
-    response = await google_client.aio.models.generate_content(
-        model=gemini_conf['model'], contents=[myfile, prompt],
-        config=types.GenerateContentConfig(
-            response_mime_type='application/json',
-            response_schema=AdModel
-        )
-    )
+    from google.genai import types
+
+    gemini_scheduler = get_gemini_scheduler()
+    await gemini_scheduler.wait_budget(key)
+    try:
+        async with stage('analyze'), circuit('gemini'):
+            response = await key.client.aio.models.generate_content(
+                model=gemini_conf.model, contents=[myfile, prompt],
+                config=types.GenerateContentConfig(
+                    response_mime_type='application/json',
+                    response_schema=AdModel
+                )
+            )
+    except Exception as e:
+        gemini_scheduler.report_error(key, e)
+        raise
+    if response.usage_metadata:
+        gemini_scheduler.record(key, response.usage_metadata.total_token_count or 0)
+        metrics.inc('tokens_total', response.usage_metadata.prompt_token_count or 0, provider='gemini', kind='prompt')
+        metrics.inc('tokens_total', response.usage_metadata.candidates_token_count or 0, provider='gemini',
+                    kind='completion')
     if response.parsed is None:
         raise Exception('Google API returned None')
     return response
 
 
-async def download_file(video_id: str, video_info):
-    cid = video_info['pages'][0]['cid']
-    res2 = await http_client.get(f'https://api.bilibili.com/x/player/playurl?bvid={video_id}&cid={cid}', headers=HEADERS)
+async def download_file(video_id: str, cid: int) -> MediaFile:
+    """下载视频到工作目录，之前下载过且还没有被删除时直接复用，用完后需要调用 workspace.release"""
+    mode = get_media_mode()
+    key = f'{video_id}:{cid}:{mode}'
+    media = workspace.acquire(key)
+    if media is not None:
+        logger.info(f'复用已下载的文件 {media.path}')
+        return media
 
-    logger.info(f"video url result : {res2.text}")
-    res2.raise_for_status()
+    params = {'bvid': video_id, 'cid': cid}
+    params.update(MUXED_PARAMS if mode == 'muxed' else DASH_PARAMS)
+    async with circuit('bilibili'):
+        res2 = await get_client('bilibili_api').get('https://api.bilibili.com/x/player/playurl', params=params, headers=HEADERS)
+        res2.raise_for_status()
+
+    logger.debug(f"video url result : {res2.text}")
     res2_json = res2.json()
     if res2_json['code'] != 0:
         raise Exception('获取播放地址失败')
 
-    url =  res2_json['data']['durl'][0]['url']
-    logger.info(f"video download url : {url}")
-
-    file = await download_url_to_file(url)
+    urls = select_urls(res2_json['data'], mode)
+    logger.info(f"media mode: {mode}, download url : {urls}")
+
+    if 'video' in urls and 'audio' in urls:
+        results = await asyncio.gather(download_url_to_file(urls['video'], '.mp4'),
+                                       download_url_to_file(urls['audio'], '.m4a'), return_exceptions=True)
+        for x in results:
+            if isinstance(x, BaseException):
+                for path in results:
+                    if isinstance(path, str):
+                        workspace.remove(path)
+                raise x
+        try:
+            # 合并后的文件大小约等于两个输入之和
+            async with workspace.reserve(sum(os.path.getsize(x) for x in results)):
+                file = await mux(*results, workspace.new_path('.mp4'))
+        finally:
+            # 合并成功时 mux 已经删除了输入文件，失败时也不再需要
+            for path in results:
+                workspace.remove(path)
+    elif 'audio' in urls:
+        file = await download_url_to_file(urls['audio'], '.m4a')
+    else:
+        file = await download_url_to_file(urls['video'], '.mp4')
 
     logger.info(f"file path : {file}")
 
@@ -171,13 +278,9 @@ async def download_file(video_id: str, video_info):
 
     logger.info(f'video file {file}, file size: {file_size_str}')
 
-    return file
+    return workspace.add(key, file)
 
 
-async def download_url_to_file(url):
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as f:
-        async with http_client.stream("GET", url, headers=HEADERS) as response:
-            response.raise_for_status()
-            async for chunk in response.aiter_bytes():
-                f.write(chunk)
-        return f.name
\ No newline at end of file
+async def download_url_to_file(url, suffix='.mp4'):
+    async with circuit('bilibili_cdn'):
+        return await workspace.download(url, suffix)
@@ -1,34 +1,249 @@
+"""
+重试：指数退避 + 随机抖动，区分可重试和不可重试的错误，遵守 Retry-After
+按上游服务熔断：某个依赖连续失败后一段时间内直接失败，不再占用每个视频的重试
+每轮处理共享一个重试预算，预算用完后失败的视频留到之后的轮次
+"""
 import asyncio
+import email.utils
+import random
+import time
+from contextlib import asynccontextmanager
 from functools import wraps
+from typing import Optional
 
+import httpx
+from bilibili_api.exceptions import ResponseCodeException
 from loguru import logger
 
+from src import metrics
+from src.config import settings
+from src.key_scheduler import is_quota_error
+
+retry_conf = settings.retry
+
+# B 站接口返回的业务错误码（负数，和 http 状态码无关）中稍后重试可以恢复的：
+# -101 未登录（凭证失效，下一轮重新校验或登录），-352、-412 风控，-500、-503 服务错误，-509 请求过于频繁
+BILIBILI_RETRYABLE_CODES = (-101, -352, -412, -500, -503, -509)
+
+
 class RetryOverException(Exception):
      pass
 
-def retry(max_retries: int = 1, delay: float = 1.0):
+
+class PermanentError(Exception):
+    """重试也不会成功的错误（参数错误、资源不存在等）"""
+    pass
+
+
+class HttpError(Exception):
+    """上游返回了失败的状态码，保留响应用于判断是否可以重试"""
+
+    def __init__(self, response: httpx.Response, message: str = '请求失败'):
+        super().__init__(f'{message} {response.status_code} {response.text}')
+        self.response = response
+        self.status_code = response.status_code
+
+
+class CircuitOpenError(Exception):
+    """上游服务已熔断，retry_in 秒后才会再次尝试"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f'{name} 已熔断，{round(retry_in)} 秒后重试')
+        self.name = name
+        self.retry_in = retry_in
+
+
+def _status_code(e: Exception) -> Optional[int]:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code
+    code = getattr(e, 'status_code', None)
+    if code is None:
+        # google.genai 的 APIError 使用 code 字段，bilibili_api 的 NetworkException 使用 status 字段
+        code = getattr(e, 'code', None)
+        if code is None:
+            code = getattr(e, 'status', None)
+    # 只接受 http 状态码，其他库的 code 可能是业务错误码
+    return code if isinstance(code, int) and 100 <= code <= 599 else None
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """从异常携带的响应中读取 Retry-After（秒数或 http 日期）"""
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None)
+    value = headers.get('retry-after') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(e: BaseException) -> bool:
+    """
+    超时、连接错误、429 和 5xx 可以重试；其他 4xx、参数错误和程序错误不重试；未知的异常默认可以重试
+    B 站的业务错误码只有 BILIBILI_RETRYABLE_CODES 中的可以重试（风控、限流等），其他（视频不存在等）不重试
+    """
+    if isinstance(e, (RetryOverException, PermanentError, CircuitOpenError)):
+        return False
+    if isinstance(e, (httpx.TransportError, asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    if isinstance(e, (KeyError, TypeError, AttributeError, NotImplementedError)):
+        return False
+    if isinstance(e, ResponseCodeException):
+        return e.code in BILIBILI_RETRYABLE_CODES
+    code = _status_code(e)
+    if code is not None:
+        return code in (408, 425, 429) or code >= 500
+    return True
+
+
+class CircuitBreaker:
+    """
+    连续 failure_threshold 次可重试的失败后熔断 reset_timeout 秒
+    之后放行一次试探请求，成功则恢复，失败则继续熔断
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def check(self):
+        state = self.state
+        if state == 'closed':
+            return
+        if state == 'half_open' and not self._probing:
+            self._probing = True
+            return
+        retry_in = self.reset_timeout - (time.monotonic() - self.opened_at) if state == 'open' else self.reset_timeout
+        raise CircuitOpenError(self.name, max(0.0, retry_in))
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f'{self.name} 已恢复')
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f'{self.name} 连续失败 {self.failures} 次，熔断 {self.reset_timeout} 秒')
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name, retry_conf.breaker_failures,
+                                                   retry_conf.breaker_reset_seconds)
+    return breaker
+
+
+@asynccontextmanager
+async def circuit(name: str):
+    """
+    调用上游服务，服务已熔断时直接抛出 CircuitOpenError
+    只有可重试的错误（超时、5xx 等）计入失败，请求本身的问题和限流不影响熔断
+    """
+    breaker = get_breaker(name)
+    breaker.check()
+    try:
+        yield
+    except BaseException as e:
+        if isinstance(e, Exception) and is_retryable(e) and not is_quota_error(e):
+            breaker.record_failure()
+        else:
+            # 取消或请求本身的错误，不说明服务有问题
+            breaker._probing = False
+        raise
+    breaker.record_success()
+
+
+class RetryBudget:
+    """每轮最多重试的次数，reset() 在每轮开始时调用"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def reset(self):
+        self.used = 0
+
+    def try_spend(self) -> bool:
+        if self.limit and self.used >= self.limit:
+            return False
+        self.used += 1
+        return True
+
+
+retry_budget = RetryBudget(retry_conf.budget_per_cycle)
+
+
+def backoff_delay(delay: float, attempt: int, max_delay: float) -> float:
+    """第 attempt 次重试（从 0 开始）的等待时间：指数增长，在 [一半, 全部] 之间随机"""
+    base = min(max_delay, delay * 2 ** attempt)
+    return random.uniform(base / 2, base)
+
+
+def retry(max_retries: int = 1, delay: float = 1.0, max_delay: float = None):
     """
     异步函数重试装饰器。
 
     :param max_retries: 最大重试次数
-    :param delay: 每次重试之间的延迟时间（单位：秒）
+    :param delay: 第一次重试前的基础等待时间（单位：秒），之后每次翻倍并加入随机抖动
+    :param max_delay: 单次等待的上限，默认读取配置 retry.max_delay；Retry-After 超过上限时不再重试
     """
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
+            limit = max_delay if max_delay is not None else retry_conf.max_delay
             for attempt in range(max_retries + 1):
                 try:
                     return await func(*args, **kwargs)
                 except RetryOverException:
                     raise
                 except Exception as e:
-                    if attempt < max_retries:
-                        logger.warning(f"Error {repr(e)} . Attempt {attempt + 1} failed. Retrying in {delay} seconds...")
-                        await asyncio.sleep(delay)
-                    else:
+                    if attempt >= max_retries:
                         logger.error(f"Error {repr(e)} . Attempt {attempt + 1} failed. No more retries.")
                         raise e
+                    if not is_retryable(e):
+                        logger.error(f"Error {repr(e)} . Attempt {attempt + 1} failed. Not retryable.")
+                        raise e
+                    wait = backoff_delay(delay, attempt, limit)
+                    after = retry_after(e)
+                    if after is not None:
+                        if after > limit:
+                            logger.error(f"Error {repr(e)} . Retry-After {after} seconds is too long, give up.")
+                            raise e
+                        wait = max(wait, after)
+                    if not retry_budget.try_spend():
+                        logger.error(f"Error {repr(e)} . Attempt {attempt + 1} failed. Retry budget exhausted.")
+                        raise e
+                    metrics.inc('retries_total', func=func.__name__)
+                    logger.warning(f"Error {repr(e)} . Attempt {attempt + 1} failed. Retrying in {round(wait, 1)} seconds...")
+                    await asyncio.sleep(wait)
             return None
 
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,109 @@
+"""
+自动模式：按视频选择成本最低、最可能成功的处理模式
+- 有可用的字幕（覆盖足够多的时长）且时长不超过 ass.max_duration 时使用字幕模式
+- 否则在 running.min_second ~ running.max_second 范围内使用视频模式（需要下载、上传视频，成本高）
+- 两种模式都不适用时跳过
+选择结果记录在任务数据的 route 字段和 route_decisions_total 指标中，各模式的任务数分别受 [pipeline] 中
+ass_concurrency / video_concurrency 限制，视频模式的任务较多时不会占满字幕模式的名额
+"""
+from bilibili_api import video
+from loguru import logger
+
+from src import metrics
+from src.ass_mode import process_video_ass, get_subtitle_body
+from src.config import settings, ass_conf, running_conf, AUTO
+from src.credential import get_credential
+from src.jobs import Job, MEDIA_FETCHED, SKIPPED
+from src.pipeline import stage
+from src.process_ad import process_video, check_exist
+from src.retry import retry, circuit
+
+router_conf = settings.router
+
+# 各处理模式对应的任务处理函数
+HANDLERS = {
+    'ass': process_video_ass,
+    'video': process_video,
+}
+
+
+def subtitle_coverage(body: list, duration: float) -> float:
+    """字幕覆盖的时长占视频时长的比例"""
+    if not body or duration <= 0:
+        return 0.0
+    covered = sum(max(0.0, x['to'] - x['from']) for x in body)
+    return min(1.0, covered / duration)
+
+
+def choose_mode(duration: int, body: list = None) -> tuple[str, str]:
+    """
+    返回 (模式, 原因)，模式为 None 表示跳过
+    body 为下载到的字幕，没有字幕轨道或者没有下载字幕时为 None
+    """
+    if settings.configured('ass') and duration <= ass_conf.max_duration:
+        if body and subtitle_coverage(body, duration) >= router_conf.min_subtitle_coverage:
+            return 'ass', 'subtitle'
+        reason = 'low_coverage' if body else 'no_subtitle'
+    elif settings.configured('ass'):
+        reason = 'too_long_for_ass'
+    else:
+        reason = 'ass_disabled'
+
+    if not settings.configured('video'):
+        return None, reason
+    if duration < running_conf.min_second or duration > running_conf.max_second:
+        return None, f'{reason}+duration'
+    return 'video', reason
+
+
+def _record(job: Job, mode: str, reason: str, coverage: float):
+    job.data['route'] = {'mode': mode or SKIPPED, 'reason': reason, 'coverage': round(coverage, 3)}
+    metrics.inc('route_decisions_total', mode=mode or SKIPPED, reason=reason)
+    logger.info(f'视频 {job.bvid} 选择{"跳过" if mode is None else f" {mode} 模式"}（{reason}，字幕覆盖 {round(coverage * 100)}%）')
+
+
+@retry(delay=10)
+async def route(job: Job):
+    """获取视频信息和字幕，选择处理模式，并保存下一阶段需要的数据，选定的模式直接从 MEDIA_FETCHED 开始"""
+    video_id = job.bvid
+    if await check_exist(video_id):
+        logger.info('视频已经处理过了，跳过.')
+        await job.finish(SKIPPED, '已处理过')
+        return
+
+    v = video.Video(bvid=video_id, credential=get_credential())
+    async with stage('meta'), circuit('bilibili'):
+        video_info = await v.get_info()
+    title = video_info['title']
+    cid = video_info['pages'][0]['cid']
+    duration = video_info['pages'][0]['duration']
+
+    body = None
+    # 字幕模式不可用时不需要下载字幕
+    if settings.configured('ass') and duration <= ass_conf.max_duration:
+        async with stage('download'), circuit('bilibili'):
+            body = await get_subtitle_body(await v.get_subtitle(cid))
+
+    mode, reason = choose_mode(duration, body)
+    _record(job, mode, reason, subtitle_coverage(body, duration))
+    if mode is None:
+        await job.finish(SKIPPED, reason)
+        return
+
+    await job.switch_mode(mode)
+    data = {'title': title, 'cid': cid, 'duration': duration}
+    if mode == 'ass':
+        data['body'] = body
+    await job.checkpoint(MEDIA_FETCHED, **data)
+
+
+async def process_job(job: Job):
+    """按任务的模式处理，自动模式的任务先选择模式"""
+    if job.mode == AUTO:
+        await route(job)
+        if job.mode == AUTO:
+            # 跳过的视频
+            return
+
+    async with stage(job.mode):
+        await HANDLERS[job.mode](job)
@@ -0,0 +1,135 @@
+"""自适应轮询：根据最近的投稿频率和时段调整拉取动态的间隔"""
+import asyncio
+import datetime
+import random
+import signal
+import time
+from collections import deque
+
+from loguru import logger
+
+from src.config import settings
+
+scheduler_conf = settings.scheduler
+
+TZ_SHANGHAI = datetime.timezone(datetime.timedelta(hours=8))
+
+
+class PollScheduler:
+    """
+    - 本轮发现新视频后，下一轮使用最短间隔，尽快跟上连续投稿
+    - 没有新视频时间隔按 backoff 倍数逐步拉长，直到 max_interval
+    - 最近 activity_window_hours 小时内的投稿越频繁，间隔上限越低
+    - quiet_hours（北京时间）内间隔不低于 quiet_interval
+    - 间隔从上一轮开始时计算，扣除本轮的执行时间；同一时间只会有一轮在执行
+    - trigger() 或 SIGUSR1 可以立即开始下一轮，执行中触发的会在本轮结束后马上执行一次
+    """
+
+    def __init__(self, min_interval: float = 120, max_interval: float = 1800, backoff: float = 1.5,
+                 activity_window_hours: float = 6, quiet_hours=(2, 7), quiet_interval: float = 1800,
+                 jitter: float = 0.1):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.activity_window = activity_window_hours * 3600
+        self.quiet_hours = tuple(quiet_hours) if quiet_hours else None
+        self.quiet_interval = quiet_interval
+        self.jitter = jitter
+        self.interval = min_interval
+        self._uploads: deque[float] = deque()
+        self._event = asyncio.Event()
+
+    def trigger(self):
+        """手动触发，立即开始下一轮"""
+        self._event.set()
+
+    def upload_rate(self, now: float = None) -> float:
+        """最近的投稿频率（个/小时）"""
+        now = now if now is not None else time.time()
+        while self._uploads and self._uploads[0] < now - self.activity_window:
+            self._uploads.popleft()
+        return len(self._uploads) * 3600 / self.activity_window
+
+    def is_quiet(self, now: float = None) -> bool:
+        if not self.quiet_hours:
+            return False
+        now = now if now is not None else time.time()
+        hour = datetime.datetime.fromtimestamp(now, TZ_SHANGHAI).hour
+        begin, end = self.quiet_hours
+        if begin <= end:
+            return begin <= hour < end
+        # 跨零点，例如 (23, 6)
+        return hour >= begin or hour < end
+
+    def observe(self, pub_times: list[int], now: float = None):
+        """记录本轮发现的新视频发布时间，更新下一轮的间隔"""
+        now = now if now is not None else time.time()
+        self._uploads.extend(sorted(x for x in pub_times if x > now - self.activity_window))
+        if pub_times:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def next_interval(self, now: float = None) -> float:
+        now = now if now is not None else time.time()
+        interval = self.interval
+        rate = self.upload_rate(now)
+        if rate > 0:
+            # 平均投稿间隔的一半作为上限，活跃时段不会等太久
+            interval = min(interval, max(self.min_interval, 3600 / rate / 2))
+        if self.is_quiet(now):
+            interval = max(interval, self.quiet_interval)
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return min(max(interval, self.min_interval), max(self.max_interval, self.quiet_interval))
+
+    async def _sleep(self, seconds: float):
+        """等待到下一轮，被手动触发时提前返回"""
+        if seconds <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout=seconds)
+            logger.info('收到手动触发，立即开始下一轮')
+        except asyncio.TimeoutError:
+            pass
+
+    def install_signal_handler(self):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.trigger)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            # Windows 不支持
+            pass
+
+    async def run(self, cycle):
+        """
+        循环执行 cycle，cycle 返回本轮新发现视频的发布时间列表
+        cycle 抛出的异常只记录日志，不会中断循环
+        """
+        self.install_signal_handler()
+        while True:
+            self._event.clear()
+            begin = time.monotonic()
+            pub_times = []
+            try:
+                pub_times = await cycle() or []
+                logger.info('------------------------')
+            except Exception as e:
+                logger.exception(f'系统执行异常: {e}')
+            self.observe(pub_times)
+            elapsed = time.monotonic() - begin
+            interval = self.next_interval()
+            wait = interval - elapsed
+            logger.info(f'本轮耗时 {round(elapsed, 1)} 秒，最近投稿 {round(self.upload_rate(), 2)} 个/小时，'
+                        f'{round(max(wait, 0))} 秒后开始下一轮')
+            await self._sleep(wait)
+
+
+poll_scheduler = PollScheduler(
+    min_interval=scheduler_conf.min_interval,
+    max_interval=scheduler_conf.max_interval,
+    backoff=scheduler_conf.backoff,
+    activity_window_hours=scheduler_conf.activity_window_hours,
+    quiet_hours=scheduler_conf.quiet_hours,
+    quiet_interval=scheduler_conf.quiet_interval,
+    jitter=scheduler_conf.jitter,
+)
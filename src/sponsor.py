@@ -0,0 +1,141 @@
+"""空降助手片段查询：批量哈希前缀查询、TTL缓存、并发请求合并"""
+import asyncio
+import hashlib
+from typing import Iterable, Optional
+
+import httpx
+from cachetools import TTLCache
+from loguru import logger
+
+from src import metrics
+from src.config import sponsor_conf
+from src.http_clients import get_client
+
+
+class SegmentLookup:
+    """
+    查询视频在空降助手上是否已有 sponsor 片段
+
+    api: 空降助手服务地址，测试时可以指向本地的替身服务
+    http_client: 发请求用的 httpx 客户端
+    """
+
+    def __init__(self, api: str, http_client: httpx.AsyncClient, ttl: float = 3600, negative_ttl: float = 600,
+                 maxsize: int = 4096, prefix_length: int = 4):
+        self.api = api.rstrip('/')
+        self.http_client = http_client
+        self.prefix_length = prefix_length
+        # 已有片段的结果不会失效太快；没有片段的结果很可能被别人补上，缓存时间更短
+        self._positive = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._negative = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    def get_cached(self, video_id: str, fresh: bool = False) -> Optional[bool]:
+        if video_id in self._positive:
+            return True
+        if not fresh and video_id in self._negative:
+            return False
+        return None
+
+    def mark(self, video_id: str, found: bool = True):
+        """记录查询结果，例如自己提交成功之后直接标记为已存在"""
+        if found:
+            self._positive[video_id] = True
+            self._negative.pop(video_id, None)
+        else:
+            self._negative[video_id] = True
+
+    def hash_prefix(self, video_id: str) -> str:
+        return hashlib.sha256(video_id.encode()).hexdigest()[:self.prefix_length]
+
+    async def exists(self, video_id: str, fresh: bool = False) -> bool:
+        """
+        fresh=True 时忽略"不存在"的缓存，用于提交前的最终确认
+        同一个视频的并发查询共享同一个请求
+        """
+        cached = self.get_cached(video_id, fresh)
+        if cached is not None:
+            metrics.inc('cache_requests_total', cache='segments', result='hit')
+            return cached
+        metrics.inc('cache_requests_total', cache='segments', result='miss')
+
+        future = self._inflight.get(video_id)
+        if future is None:
+            future = self._start(video_id, self._fetch_one(video_id))
+        return await asyncio.shield(future)
+
+    def _start(self, key: str, coro) -> asyncio.Future:
+        future = asyncio.ensure_future(coro)
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None) if self._inflight.get(key) is future else None)
+        return future
+
+    async def _fetch_one(self, video_id: str) -> bool:
+        res = await self.http_client.get(f'{self.api}/api/skipSegments',
+                                         params={'videoID': video_id, 'category': 'sponsor'}, timeout=60)
+        if res.status_code == 404:
+            self.mark(video_id, False)
+            return False
+        if res.is_success:
+            found = len(res.json()) > 0
+            self.mark(video_id, found)
+            return found
+        logger.warning(f'查询片段失败 {video_id}: {res.status_code} {res.text}')
+        return False
+
+    async def prefetch(self, video_ids: Iterable[str]):
+        """
+        通过 /api/skipSegments/{sha256前缀} 批量查询并写入缓存
+        前缀相同的视频只发一次请求，已有缓存或正在查询的视频会被跳过
+        """
+        groups: dict[str, list[str]] = {}
+        for video_id in dict.fromkeys(video_ids):
+            if self.get_cached(video_id) is not None or video_id in self._inflight:
+                continue
+            groups.setdefault(self.hash_prefix(video_id), []).append(video_id)
+        if not groups:
+            return
+
+        futures = []
+        for prefix, ids in groups.items():
+            future = asyncio.ensure_future(self._fetch_prefix(prefix, ids))
+            futures.append(future)
+            # 批量查询期间，同一视频的单个查询直接等待批量结果
+            for video_id in ids:
+                self._start(video_id, self._wait_prefix(future, video_id))
+        await asyncio.gather(*futures, return_exceptions=True)
+        logger.debug(f'批量查询片段 {sum(len(x) for x in groups.values())} 个视频，请求 {len(groups)} 次')
+
+    async def _wait_prefix(self, future: asyncio.Future, video_id: str) -> bool:
+        try:
+            await future
+        except Exception:
+            pass
+        cached = self.get_cached(video_id)
+        if cached is None:
+            # 批量查询失败，退回单个查询
+            return await self._fetch_one(video_id)
+        return cached
+
+    async def _fetch_prefix(self, prefix: str, video_ids: list[str]):
+        res = await self.http_client.get(f'{self.api}/api/skipSegments/{prefix}',
+                                         params={'category': 'sponsor'}, timeout=60)
+        if res.status_code == 404:
+            found = set()
+        elif res.is_success:
+            found = {x['videoID'] for x in res.json() if x.get('segments')}
+        else:
+            logger.warning(f'批量查询片段失败 {prefix}: {res.status_code} {res.text}')
+            return
+        for video_id in video_ids:
+            self.mark(video_id, video_id in found)
+
+
+segment_lookup = SegmentLookup(
+    sponsor_conf.api,
+    get_client('sponsor'),
+    ttl=sponsor_conf.cache_ttl,
+    negative_ttl=sponsor_conf.negative_cache_ttl,
+    maxsize=sponsor_conf.cache_size,
+    prefix_length=sponsor_conf.hash_prefix_length,
+)
@@ -0,0 +1,151 @@
+"""字幕处理：token 估算、压缩、按时间窗口切分、合并各窗口的识别结果"""
+import math
+import re
+
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日文及全角字符按 1 个 token，其他字符按 4 个字符 1 个 token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def format_line(item) -> str:
+    return f"[{item['from']} - {item['to']}] {item['content']}"
+
+
+def split_windows(body: list, max_tokens: int, overlap_seconds: float, formatter=format_line) -> list[list]:
+    """
+    按 token 预算把字幕切成若干时间窗口，相邻窗口之间重叠 overlap_seconds 秒，
+    避免广告正好跨在窗口边界上时被截断
+    """
+    if not body:
+        return []
+
+    windows = []
+    start = 0
+    while start < len(body):
+        tokens = 0
+        end = start
+        while end < len(body):
+            tokens += estimate_tokens(formatter(body[end])) + 1
+            if tokens > max_tokens and end > start:
+                break
+            end += 1
+        windows.append(body[start:end])
+        if end >= len(body):
+            break
+
+        # 下一个窗口从本窗口结束前 overlap_seconds 秒开始，但至少前进一行
+        boundary = body[end - 1]['to'] - overlap_seconds
+        next_start = end
+        while next_start - 1 > start and body[next_start - 1]['from'] >= boundary:
+            next_start -= 1
+        start = max(next_start, start + 1)
+    return windows
+
+
+def merge_segments(segments: list[dict], gap: float = 2.0) -> list[dict]:
+    """合并重叠或间隔小于 gap 秒的同类型片段（来自相邻窗口的重复识别）"""
+    merged = []
+    for seg in sorted(segments, key=lambda x: (x['actionType'], x['start'])):
+        last = merged[-1] if merged else None
+        if last and last['actionType'] == seg['actionType'] and seg['start'] <= last['end'] + gap:
+            last['end'] = max(last['end'], seg['end'])
+            if seg['reason'] not in last['reason']:
+                last['reason'] = f"{last['reason']}；{seg['reason']}"
+            continue
+        merged.append(dict(seg))
+    return sorted(merged, key=lambda x: x['start'])
+
+
+# 常见的口水词/语气词，整行只有这些内容时直接丢弃
+FILLER_WORDS = {'嗯', '啊', '呃', '哦', '额', '嗯嗯', '啊啊', '哈', '哈哈', '哈哈哈', '对', '对对', '对对对', '好', '好的', '那个', '就是', '然后'}
+
+_PUNCTUATION = re.compile(r'[\s,.!?;:，。！？；：、~～…]+')
+
+
+def format_compact_line(item, precision: int = 0) -> str:
+    """时间戳按 precision 位小数显示，开始时间向下取、结束时间向上取，保证显示范围覆盖原始范围"""
+    scale = 10 ** precision
+    start = math.floor(item['from'] * scale) / scale
+    end = math.ceil(item['to'] * scale) / scale
+    if precision == 0:
+        start, end = int(start), int(end)
+    return f"[{start}-{end}] {item['content']}"
+
+
+def _is_filler(content: str, filler_words) -> bool:
+    text = _PUNCTUATION.sub('', content)
+    return not text or text in filler_words
+
+
+def _compact(body: list, max_gap: float, max_chars: int, filler_words) -> list[dict]:
+    spans = []
+    last_content = None
+    for item in body:
+        content = item['content'].strip()
+        if _is_filler(content, filler_words) or content == last_content:
+            continue
+        last_content = content
+
+        cur = spans[-1] if spans else None
+        if (cur and item['from'] - cur['to'] <= max_gap
+                and len(cur['content']) + len(content) + 1 <= max_chars):
+            cur['content'] = f"{cur['content']} {content}"
+            cur['to'] = max(cur['to'], item['to'])
+            cur['lines'] += 1
+            continue
+        spans.append({'from': item['from'], 'to': item['to'], 'content': content, 'lines': 1})
+    return spans
+
+
+def compact(body: list, token_budget: int, precision: int = 0, max_gap: float = 1.0, max_chars: int = 40,
+            filler_words=FILLER_WORDS) -> tuple[list[dict], dict]:
+    """
+    压缩字幕：丢弃口水词和重复行，把间隔很短的相邻短句合并成一段
+    超出 token 预算时逐步放宽合并长度，仍然超出的部分交给窗口切分处理
+    每段的 from/to 保留原始字幕的精确时间，识别结果再用 snap_segments 对齐回原始时间戳
+    返回 (压缩后的字幕段, 统计信息)
+    """
+    before = sum(estimate_tokens(format_line(x)) + 1 for x in body)
+    spans = _compact(body, max_gap, max_chars, filler_words)
+    after = sum(estimate_tokens(format_compact_line(x, precision)) + 1 for x in spans)
+    while after > token_budget and max_chars < 320:
+        max_chars *= 2
+        spans = _compact(body, max_gap * 2, max_chars, filler_words)
+        after = sum(estimate_tokens(format_compact_line(x, precision)) + 1 for x in spans)
+
+    stats = {
+        'lines': len(body),
+        'spans': len(spans),
+        'tokens_before': before,
+        'tokens_after': after,
+        'saved_ratio': round(1 - after / before, 3) if before else 0,
+    }
+    return spans, stats
+
+
+def snap_segments(segments: list[dict], body: list[dict], tolerance: float = 1.0) -> list[dict]:
+    """
+    模型看到的是取整后的时间，把返回的开始/结束时间对齐到 tolerance 秒内最接近的原始字幕行边界，
+    得到原始字幕的精确时间；附近没有字幕行边界时保留模型返回的时间
+    """
+    if not body:
+        return segments
+    starts = [x['from'] for x in body]
+    ends = [x['to'] for x in body]
+
+    def nearest(value, candidates):
+        best = min(candidates, key=lambda x: abs(x - value))
+        return best if abs(best - value) <= tolerance else value
+
+    result = []
+    for seg in segments:
+        start = nearest(seg['start'], starts)
+        end = nearest(seg['end'], ends)
+        if end <= start:
+            start, end = seg['start'], seg['end']
+        result.append({**seg, 'start': start, 'end': end})
+    return result
@@ -1,10 +1,10 @@
+import asyncio
 import datetime
+import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-import httpx
-from bilibili_api import HEADERS
-
-http_client = httpx.AsyncClient()
+from src import metrics
 
 def is_near(item):
     pub_ts = item['modules']['module_author']['pub_ts']
@@ -24,13 +24,51 @@ def is_near(item):
     # 检查是否是新发布的视频，并预留一点缓冲时间
     return time_diff < 1.5 * 30 * 60
 
-async def download_video(url):
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as f:
-        async with http_client.stream("GET", url, headers=HEADERS) as response:
-            response.raise_for_status()
+# 写盘专用的线程池，不占用默认线程池（其他 run_in_executor、to_thread 调用不会和写盘互相等待）
+_write_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='disk')
+
+
+async def stream_to_file(response, suffix='.mp4', directory: str = None, prefix: str = None):
+    """
+    把 http 响应流写入临时文件（directory 为空时使用系统临时目录），写盘在专用线程池中进行，不阻塞事件循环
+    同一时间最多一块在写盘、一块在下载：写盘慢时下载随之放慢，写盘出错时立即停止下载
+    下载失败时会删除临时文件
+    """
+    loop = asyncio.get_running_loop()
+    f = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, prefix=prefix, dir=directory)
+    pending = None
+    size = 0
+    try:
+        try:
             async for chunk in response.aiter_bytes():
-                f.write(chunk)
-        return f.name
+                if pending is not None:
+                    # shield：被取消时不影响正在进行的写入，finally 中等它结束再关闭文件
+                    await asyncio.shield(pending)
+                pending = loop.run_in_executor(_write_executor, f.write, chunk)
+                size += len(chunk)
+            if pending is not None:
+                await asyncio.shield(pending)
+        finally:
+            metrics.inc('download_bytes_total', size, kind='media')
+            if pending is not None:
+                await asyncio.wait([pending])
+                if not pending.cancelled():
+                    # 已经抛出过的异常不再处理，避免 "exception was never retrieved"
+                    pending.exception()
+            f.close()
+    except BaseException:
+        remove_file(f.name)
+        raise
+    return f.name
+
+
+def remove_file(path):
+    """删除临时文件，文件不存在时忽略"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 
 def get_now_str():
     tz_shanghai = datetime.timezone(datetime.timedelta(hours=8))
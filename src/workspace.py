@@ -0,0 +1,248 @@
+"""
+下载的音视频文件统一放在工作目录中，按配额管理磁盘空间
+- 上传完成后引用计数归零即删除；上传失败的文件保留下来供重试复用，空间不足时按最久未使用淘汰
+- 空间不足且没有可淘汰的文件时，新的下载等待正在使用的文件释放；没有可以等待的文件时放行一个下载，避免互相等待
+- 每个实例使用工作目录下以实例标识（claims.worker_id）命名的子目录，文件名带有固定前缀，
+  启动后第一次使用时只清理这个子目录中本程序创建的、上次遗留的文件，不会删除其他文件
+- 没有配置 worker_id 时子目录名为 主机名-进程号，同时清理本机上进程已经退出的实例留下的子目录
+"""
+import asyncio
+import os
+import re
+import socket
+import tempfile
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+from bilibili_api import HEADERS
+from loguru import logger
+
+from src.claims import worker_id
+from src.config import settings
+from src.http_clients import get_client
+from src.utils import stream_to_file, remove_file
+
+workspace_conf = settings.workspace
+
+MB = 1024 * 1024
+# 工作目录中本程序创建的文件都使用这个前缀
+FILE_PREFIX = 'sponsor-media-'
+
+
+@dataclass
+class MediaFile:
+    key: str
+    path: str
+    refs: int = 1
+
+
+class MediaWorkspace:
+    def __init__(self, root: str, quota_bytes: int, default_reserve: int = 64 * MB, keep_downloads: bool = True):
+        self.root = root
+        self.quota = quota_bytes
+        self.default_reserve = default_reserve
+        self.keep_downloads = keep_downloads
+        self._paths: set[str] = set()
+        # 按最近使用排序，最久未使用的在前面
+        self._cached: OrderedDict[str, MediaFile] = OrderedDict()
+        self._reserved = 0
+        self._ready = False
+        self._changed = asyncio.Event()
+
+    def _ensure_root(self):
+        if self._ready:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        removed = _remove_own_files(self.root)
+        for directory in _stale_siblings(self.root):
+            removed += _remove_own_files(directory)
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # 目录中还有其他文件
+                pass
+        if removed:
+            logger.info(f'清理工作目录中上次遗留的 {removed} 个文件')
+        self._ready = True
+
+    def used(self) -> int:
+        """工作目录中文件占用的字节数，已经被删除的文件不再统计"""
+        total = 0
+        for path in list(self._paths):
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                self._paths.discard(path)
+        return total
+
+    def stats(self) -> dict:
+        return {
+            'used': self.used(),
+            'reserved': self._reserved,
+            'quota': self.quota,
+            'files': len(self._paths),
+            'cached': sum(1 for x in self._cached.values() if x.refs == 0),
+        }
+
+    def new_path(self, suffix: str = '') -> str:
+        """在工作目录中创建一个空文件并登记"""
+        self._ensure_root()
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix=FILE_PREFIX, dir=self.root)
+        os.close(fd)
+        self._paths.add(path)
+        return path
+
+    def remove(self, path: str):
+        remove_file(path)
+        self._paths.discard(path)
+        self._changed.set()
+
+    def _evict(self, needed: int) -> bool:
+        """淘汰没有被使用的缓存文件，直到腾出 needed 字节或者没有可淘汰的文件，返回是否淘汰了文件"""
+        evicted = False
+        freed = 0
+        for key, media in list(self._cached.items()):
+            if freed >= needed:
+                break
+            if media.refs > 0:
+                continue
+            try:
+                freed += os.path.getsize(media.path)
+            except FileNotFoundError:
+                pass
+            del self._cached[key]
+            self.remove(media.path)
+            evicted = True
+            logger.debug(f'工作目录空间不足，淘汰 {key}')
+        return evicted
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        """预留 size 字节，空间不足时等待"""
+        self._ensure_root()
+        # 超过配额的单个文件按配额预留，工作目录为空时总能开始
+        size = min(size, self.quota)
+        while True:
+            free = self.quota - self.used() - self._reserved
+            if size <= free:
+                break
+            if self._evict(size - free):
+                continue
+            if self._reserved == 0 and not any(x.refs > 0 for x in self._cached.values()):
+                # 没有其他下载在进行，也没有正在使用、稍后会释放的文件，放行一个，保证总能向前推进
+                logger.warning(f'工作目录配额不足，已使用 {round(self.used() / MB)}MB，仍然继续下载 {round(size / MB)}MB')
+                break
+            logger.info(f'工作目录空间不足，等待其他文件释放（需要 {round(size / MB)}MB，剩余 {round(max(free, 0) / MB)}MB）')
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+        self._reserved += size
+        try:
+            yield
+        finally:
+            self._reserved -= size
+            self._changed.set()
+
+    async def download(self, url: str, suffix: str = '.mp4') -> str:
+        """下载到工作目录，按 Content-Length 预留空间"""
+        self._ensure_root()
+        async with get_client('bilibili_cdn').stream("GET", url, headers=HEADERS) as response:
+            response.raise_for_status()
+            size = int(response.headers.get('content-length') or 0) or self.default_reserve
+            async with self.reserve(size):
+                path = await stream_to_file(response, suffix, directory=self.root, prefix=FILE_PREFIX)
+                self._paths.add(path)
+        return path
+
+    def acquire(self, key: str) -> Optional[MediaFile]:
+        """获取已经下载好的文件，引用计数加一"""
+        media = self._cached.get(key)
+        if media is None:
+            return None
+        if not os.path.exists(media.path):
+            del self._cached[key]
+            return None
+        media.refs += 1
+        self._cached.move_to_end(key)
+        return media
+
+    def add(self, key: str, path: str) -> MediaFile:
+        """登记下载完成的文件，引用计数为一"""
+        old = self._cached.pop(key, None)
+        if old is not None and old.path != path and old.refs == 0:
+            self.remove(old.path)
+        self._paths.add(path)
+        media = MediaFile(key, path)
+        self._cached[key] = media
+        return media
+
+    def release(self, media: MediaFile, done: bool):
+        """
+        释放引用，done=True 表示文件已经用完（上传或分析完成），没有其他引用时立即删除
+        done=False 时保留文件，重试时可以直接复用，空间不足时会被淘汰
+        """
+        media.refs = max(0, media.refs - 1)
+        if media.refs == 0 and (done or not self.keep_downloads):
+            if self._cached.get(media.key) is media:
+                del self._cached[media.key]
+            self.remove(media.path)
+        self._changed.set()
+
+
+def _dir_name(name: str) -> str:
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def _remove_own_files(directory: str) -> int:
+    """删除目录中本程序创建的文件，返回删除的个数"""
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(FILE_PREFIX) and os.path.isfile(path):
+            remove_file(path)
+            removed += 1
+    return removed
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # 进程存在，属于其他用户
+        return True
+    return True
+
+
+def _stale_siblings(root: str) -> list[str]:
+    """同一目录下本机其他默认实例标识（主机名-进程号）的子目录中，进程已经退出的"""
+    # Windows 上 os.kill 会结束进程，不能用来检测
+    if os.name != 'posix':
+        return []
+    base = os.path.dirname(root)
+    pattern = re.compile(re.escape(_dir_name(socket.gethostname())) + r'-(\d+)')
+    stale = []
+    for name in os.listdir(base):
+        path = os.path.join(base, name)
+        match = pattern.fullmatch(name)
+        if match and path != root and os.path.isdir(path) and not _pid_alive(int(match.group(1))):
+            stale.append(path)
+    return stale
+
+
+def _default_root() -> str:
+    base = workspace_conf.dir or os.path.join(tempfile.gettempdir(), 'sponsor-helper-media')
+    return os.path.join(base, _dir_name(worker_id()))
+
+
+workspace = MediaWorkspace(
+    _default_root(),
+    int(workspace_conf.quota_mb * MB),
+    default_reserve=int(workspace_conf.default_reserve_mb * MB),
+    keep_downloads=workspace_conf.keep_downloads,
+)